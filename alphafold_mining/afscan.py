@@ -0,0 +1,240 @@
+# Scan AlphaFold database models for a whole proteome using several processes.
+#
+# Each model file is read with the lightweight atom reader in alphafold_files.py
+# instead of opening a ChimeraX structure, so the worker processes do not need ChimeraX.
+# The models can be in a directory or in an AlphaFold database proteome tar file.
+
+def scan_for_close_cysteines(ulist, alphafold_dir, max_distance, processes = None, cache = None,
+                             results_path = None, parameters = None):
+    '''
+    Find close SG atoms between cysteines in different paired helix cysteine groups.
+    The ulist contains (uniprot_id, name, paired_hel_cys, tm_res_ranges) and
+    results are returned in the same order as ulist.  If an AtomCache is given
+    the atoms are taken from the cache instead of reading the model files.
+
+    If a results path is given each result is appended to that CSV file as soon as
+    it is computed and entries already in the file are not computed again, so an
+    interrupted scan can be resumed.  Models that cannot be read are reported and
+    skipped, and are tried again when the scan is rerun.  The parameters dictionary
+    describing the search (features, gap, distance, input files) is saved in the
+    results file and a scan is not resumed from a file made with other parameters.
+    '''
+    entries = [(uniprot_id, name, paired_hel_cys, tm_res_ranges)
+               for uniprot_id, name, paired_hel_cys, tm_res_ranges in ulist
+               if len(paired_hel_cys) >= 2]
+
+    if parameters is None:
+        parameters = {'max_distance': max_distance, 'alphafold_dir': alphafold_dir}
+    results = ScanResults(results_path, parameters)
+    todo = [e for e in entries if not results.done(e[0])]
+    if cache is not None:
+        computed = (_cached_close_cysteines(cache, uniprot_id, paired_hel_cys, max_distance)
+                    for uniprot_id, name, paired_hel_cys, tm_res_ranges in todo)
+    else:
+        # Make the saved model index once before starting worker processes.
+        from alphafold_files import alphafold_models
+        alphafold_models(alphafold_dir)
+        tasks = [(alphafold_dir, uniprot_id, paired_hel_cys, max_distance)
+                 for uniprot_id, name, paired_hel_cys, tm_res_ranges in todo]
+        computed = parallel_imap(_helix_pair_close_cysteines, tasks, processes)
+    for (uniprot_id, name, paired_hel_cys, tm_res_ranges), (status, value) in zip(todo, computed):
+        results.add(uniprot_id, name, status, value, tm_res_ranges)
+        if status == 'error':
+            print(f'Skipped AlphaFold model {uniprot_id}: {value}')
+    results.close()
+
+    found = []
+    missing = []
+    for uniprot_id, name, paired_hel_cys, tm_res_ranges in entries:
+        status, close_pairs = results.result(uniprot_id)
+        if status == 'missing':
+            missing.append((uniprot_id, name))
+        elif status == 'found':
+            found.append((uniprot_id, name, close_pairs, tm_res_ranges))
+    return found, missing
+
+def _helix_pair_close_cysteines(task):
+    alphafold_dir, uniprot_id, paired_hel_cys, max_distance = task
+    try:
+        from alphafold_files import read_alphafold_atoms
+        atoms = read_alphafold_atoms(alphafold_dir, uniprot_id, atom_names = ('SG',), residue_names = ('CYS',))
+        if atoms is None:
+            return ('missing', None)
+        close_pairs = helix_pair_close_cysteines(atoms, paired_hel_cys, max_distance)
+    except Exception as e:
+        return ('error', f'{type(e).__name__}: {e}')
+    return ('found' if close_pairs else 'none', close_pairs)
+
+def _cached_close_cysteines(cache, uniprot_id, paired_hel_cys, max_distance):
+    if uniprot_id in cache.errors:
+        return ('error', cache.errors[uniprot_id])	# Model file could not be read.
+    atoms = cache.atoms(uniprot_id, atom_names = ('SG',), residue_names = ('CYS',))
+    if atoms is None:
+        return ('missing', None)
+    close_pairs = helix_pair_close_cysteines(atoms, paired_hel_cys, max_distance)
+    return ('found' if close_pairs else 'none', close_pairs)
+
+class ScanResults:
+    '''
+    Scan results for each UniProt id, optionally saved in an append-only CSV file
+    which is also the checkpoint for resuming a scan.  Each line is written and
+    flushed as soon as the result is known.  Columns are UniProt id, status
+    (found, none, missing or error), name, close residue pairs, transmembrane
+    ranges and error message.  The first line records the scan parameters as JSON
+    and an existing file with different parameters raises ValueError.
+    '''
+    def __init__(self, path = None, parameters = None):
+        self._results = {}	# UniProt id -> (status, close pairs)
+        self._file = self._writer = None
+        if path is None:
+            return
+        import json
+        params = json.dumps(parameters, sort_keys = True)
+        from os.path import exists
+        import csv
+        new = not exists(path)
+        if not new:
+            with open(path, 'r', newline = '') as file:
+                first = file.readline()
+                file_params = first[len('# Parameters: '):].strip() if first.startswith('# Parameters: ') else None
+                if file_params != params:
+                    raise ValueError(f'Scan results file {path} was made with parameters {file_params}'
+                                     f' which differ from the current parameters {params}.'
+                                     '  Use a different results file name or remove the old file.')
+                for row in csv.reader(file):
+                    if len(row) == 6 and not row[0].startswith('#'):
+                        # Later lines replace earlier ones, e.g. an error fixed on rerun.
+                        uniprot_id, status, name, pairs, tm_ranges, message = row
+                        close_pairs = [tuple(int(r) for r in p.split(':')) for p in pairs.split()]
+                        self._results[uniprot_id] = (status, close_pairs)
+        self._file = open(path, 'a', newline = '')
+        if not new and self._file.tell() > 0:
+            with open(path, 'rb') as file:
+                file.seek(-1, 2)
+                if file.read(1) != b'\n':
+                    self._file.write('\n')	# Last line was cut off by an interruption.
+        self._writer = csv.writer(self._file)
+        if new:
+            self._file.write(f'# Parameters: {params}\n')
+            self._file.write('# UniProt ID, status, protein name, residue numbers of close paired cysteines, transmembrane ranges, error\n')
+
+    def done(self, uniprot_id):
+        r = self._results.get(uniprot_id)
+        return r is not None and r[0] != 'error'
+
+    def result(self, uniprot_id):
+        return self._results.get(uniprot_id, ('error', None))
+
+    def add(self, uniprot_id, name, status, value, tm_res_ranges):
+        close_pairs = value if status in ('found', 'none') else None
+        self._results[uniprot_id] = (status, close_pairs)
+        if self._writer:
+            rpairs = ' '.join(f'{r1}:{r2}' for r1,r2 in close_pairs) if close_pairs else ''
+            tmranges = ' '.join(f'{r1}-{r2}' for r1,r2 in tm_res_ranges)
+            message = value if status == 'error' else ''
+            self._writer.writerow((uniprot_id, status, name, rpairs, tmranges, message))
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = self._writer = None
+
+def helix_pair_close_cysteines(atoms, paired_hel_cys, max_distance):
+    '''
+    Return residue number pairs (rnum1, rnum2) with SG atoms within max_distance
+    where rnum1 and rnum2 are in different paired helix cysteine groups.
+    '''
+    # A residue in overlapping feature ranges belongs to several groups.
+    groups = {}
+    for g,ph in enumerate(paired_hel_cys):
+        for rnum in ph:
+            groups.setdefault(rnum, []).append(g)
+    r1, r2 = close_residue_pairs(atoms, max_distance, residues1 = list(groups.keys()),
+                                 residues2 = list(groups.keys()))
+    pairs = [(g1, g2, rnum1, rnum2) for rnum1, rnum2 in zip(r1.tolist(), r2.tolist())
+             for g1 in groups[rnum1] for g2 in groups[rnum2] if g1 < g2]
+    pairs.sort()	# Order by group pair as when comparing groups pairwise.
+    return [(rnum1, rnum2) for g1, g2, rnum1, rnum2 in pairs]
+
+def close_cysteines(atoms, membrane_residue_ranges, max_distance = 5):
+    '''
+    Same as close_cysteines() in cyssearch_v3.py but using atom arrays, for example
+    from an AtomCache, instead of a ChimeraX structure.
+    '''
+    mb_res_nums = set()
+    for b,e in membrane_residue_ranges:
+        mb_res_nums.update(range(b,e+1))
+    r1, r2 = close_residue_pairs(atoms, max_distance, residues1 = list(mb_res_nums))
+    pairs = set((min(rnum1, rnum2), max(rnum1, rnum2))
+                for rnum1, rnum2 in zip(r1.tolist(), r2.tolist()) if rnum1 != rnum2)
+    return list(pairs)
+
+def close_residue_pairs(atoms, max_distance,
+                        residue_names1 = ('CYS',), atom_names1 = ('SG',), residues1 = None,
+                        residue_names2 = None, atom_names2 = None, residues2 = None,
+                        distances = False):
+    '''
+    Find residue pairs with atoms within max_distance.  The first and second set of atoms
+    are chosen by residue names, atom names and residue numbers, with None meaning
+    any value.  If the second set residue and atom names are None they are the same
+    as the first set.  Returns arrays of residue numbers, residue numbers, and if
+    requested distances.  Pairs with a single atom in both sets are included.
+    '''
+    if residue_names2 is None and atom_names2 is None:
+        residue_names2, atom_names2 = residue_names1, atom_names1
+    i1 = atom_indices(atoms, residue_names1, atom_names1, residues1)
+    i2 = atom_indices(atoms, residue_names2, atom_names2, residues2)
+    xyz = atoms['xyz']
+    p1, p2, d = close_point_pairs(xyz[i1], xyz[i2], max_distance, distances = True)
+    rnums = atoms['residue_number']
+    r1, r2 = rnums[i1[p1]], rnums[i2[p2]]
+    return (r1, r2, d) if distances else (r1, r2)
+
+def atom_indices(atoms, residue_names = None, atom_names = None, residue_numbers = None):
+    from numpy import ones, isin
+    mask = ones((len(atoms['residue_number']),), bool)
+    if residue_names is not None:
+        mask &= isin(atoms['residue_name'], residue_names)
+    if atom_names is not None:
+        mask &= isin(atoms['atom_name'], atom_names)
+    if residue_numbers is not None:
+        mask &= isin(atoms['residue_number'], residue_numbers)
+    return mask.nonzero()[0]
+
+def close_point_pairs(xyz1, xyz2, max_distance, distances = False):
+    '''
+    Return index arrays i1, i2 for all pairs of points from xyz1 and xyz2 within
+    max_distance, sorted by i1 then i2, using a k-d tree.  Optionally also return
+    the pair distances.
+    '''
+    from numpy import empty, int64, float64, lexsort
+    if len(xyz1) == 0 or len(xyz2) == 0:
+        i1 = i2 = empty((0,), int64)
+        d = empty((0,), float64)
+    else:
+        from scipy.spatial import cKDTree
+        pairs = cKDTree(xyz1).sparse_distance_matrix(cKDTree(xyz2), max_distance,
+                                                    output_type = 'ndarray')
+        order = lexsort((pairs['j'], pairs['i']))
+        i1, i2, d = pairs['i'][order], pairs['j'][order], pairs['v'][order]
+    return (i1, i2, d) if distances else (i1, i2)
+
+def parallel_map(func, tasks, processes = None, chunksize = 16):
+    '''
+    Apply func to each task using a pool of processes returning results in task order.
+    If processes is 1 no worker processes are used.
+    '''
+    return list(parallel_imap(func, tasks, processes, chunksize))
+
+def parallel_imap(func, tasks, processes = None, chunksize = 16):
+    '''Same as parallel_map() but yields each result in order as soon as it is ready.'''
+    if processes == 1:
+        for task in tasks:
+            yield func(task)
+        return
+    # Use spawn instead of fork since forking a graphical ChimeraX is not safe.
+    from multiprocessing import get_context
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = processes, mp_context = get_context('spawn')) as pool:
+        yield from pool.map(func, tasks, chunksize = chunksize)
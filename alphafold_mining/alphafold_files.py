@@ -0,0 +1,457 @@
+# Read atom coordinates from AlphaFold database files without making ChimeraX structures.
+#
+# Opening a file as a ChimeraX AtomicStructure creates residues, bonds, ribbons...
+# which is slow if we only need a few atom coordinates from each of 20,000 files.
+# This code reads only the needed columns of the mmCIF atom_site table and does
+# not need ChimeraX, so it can be used in separate worker processes.
+
+def read_mmcif_atoms(path, atom_names = None, residue_names = None):
+    '''
+    Read atoms from the first model in an mmCIF file returning a dictionary of numpy arrays
+    with keys atom_name, residue_name, chain_id, residue_number, element, xyz, bfactor.
+    Optionally read only atoms with the given atom names and residue names.
+    '''
+    with open_text(path) as file:
+        return parse_mmcif_atoms(file, atom_names, residue_names)
+
+def open_text(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+_atom_site_fields = ('label_atom_id', 'label_comp_id', 'auth_asym_id', 'auth_seq_id',
+                     'type_symbol', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'B_iso_or_equiv',
+                     'pdbx_PDB_model_num')
+
+def parse_mmcif_atoms(lines, atom_names = None, residue_names = None):
+    # Find the atom_site table column names.
+    lines = iter(lines)
+    fields = []
+    for line in lines:
+        if line.startswith('_atom_site.'):
+            fields.append(line.strip()[11:])
+        elif fields:
+            break
+    else:
+        return atom_columns([])
+    col = {name:i for i,name in enumerate(fields)}
+    ci = [col.get(name) for name in _atom_site_fields]
+    if None in ci[:8]:
+        missing = [name for name,c in zip(_atom_site_fields[:8], ci[:8]) if c is None]
+        raise ValueError(f'mmCIF atom_site table is missing columns {", ".join(missing)}')
+    ia, ir, ic, irn, ie, ix, iy, iz, ib, im = ci
+
+    # Quick substring test to skip lines that cannot match.
+    quick = None if atom_names is None else tuple(f' {name} ' for name in atom_names)
+
+    rows = []
+    model = None
+    nf = len(fields)
+    while line:
+        if line.startswith('#') or line.startswith('loop_') or line.startswith('_'):
+            break
+        if quick is None or any(q in line for q in quick):
+            values = line.split() if '"' not in line and "'" not in line else _split_quoted(line)
+            if len(values) == nf:
+                if im is not None:
+                    if model is None:
+                        model = values[im]
+                    elif values[im] != model:
+                        break	# Only read the first model
+                if ((atom_names is None or values[ia] in atom_names) and
+                    (residue_names is None or values[ir] in residue_names)):
+                    rows.append((values[ia], values[ir], values[ic], values[irn], values[ie],
+                                 values[ix], values[iy], values[iz],
+                                 '0' if ib is None else values[ib]))
+        line = next(lines, '')
+
+    return atom_columns(rows)
+
+def _split_quoted(line):
+    import shlex
+    return [(v[1:-1] if v[:1] in ('"', "'") else v) for v in shlex.split(line, posix = False)]
+
+def atom_columns(rows):
+    from numpy import array, float32, int32, empty
+    if len(rows) == 0:
+        return {'atom_name': array([], str), 'residue_name': array([], str),
+                'chain_id': array([], str), 'residue_number': empty((0,), int32),
+                'element': array([], str), 'xyz': empty((0,3), float32),
+                'bfactor': empty((0,), float32)}
+    a = array(rows)
+    atoms = {
+        'atom_name': a[:,0].astype(str),
+        'residue_name': a[:,1].astype(str),
+        'chain_id': a[:,2].astype(str),
+        'residue_number': a[:,3].astype(int32),
+        'element': a[:,4].astype(str),
+        'xyz': a[:,5:8].astype(float32),
+        'bfactor': a[:,8].astype(float32),
+    }
+    return atoms
+
+#
+# AlphaFold database proteome downloads are tar files containing gzip compressed
+# mmCIF and PDB files for every model.  Extracting 20,000 models doubles the disk
+# use and is slow, so instead we index the tar members once and read single members
+# on demand by seeking to their position in the tar file.
+#
+def parse_alphafold_filename(filename):
+    '''
+    Return (uniprot_id, fragment, version, format) for file names like
+    AF-Q8WZ42-F3-model_v4.cif.gz or None if the name does not match.
+    Format is cif, pdb, or pae for predicted aligned error .json files.
+    '''
+    from os.path import basename
+    import re
+    m = re.match(r'AF-(.+)-F(\d+)-(?:model_v(\d+)\.(cif|pdb)|predicted_aligned_error_v(\d+)\.json)(?:\.gz)?$',
+                 basename(filename))
+    if m is None:
+        return None
+    uniprot_id, fragment, version, format, pae_version = m.groups()
+    if format is None:
+        version, format = pae_version, 'pae'
+    return uniprot_id, int(fragment), int(version), format
+
+class AlphaFoldArchive:
+    '''Read AlphaFold models from a proteome tar file without extracting it.'''
+    def __init__(self, tar_path):
+        self.path = tar_path
+        self._members = tar_member_index(tar_path)	# Member name -> (offset, size)
+        # Map (uniprot_id, fragment, format) to member name of the latest version.
+        self._models = latest_model_versions(self._members.keys())
+
+    def uniprot_ids(self):
+        return sorted(set(uniprot_id for uniprot_id, fragment, format in self._models.keys()))
+
+    def num_fragments(self, uniprot_id, format = 'cif'):
+        n = 0
+        while (uniprot_id, n+1, format) in self._models:
+            n += 1
+        return n
+
+    def model_name(self, uniprot_id, fragment = 1, format = 'cif'):
+        return self._models.get((uniprot_id, fragment, format))
+
+    def read_member(self, name):
+        '''Return contents of a tar member, uncompressed if it is gzipped.'''
+        offset, size = self._members[name]
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            data = file.read(size)
+        if name.endswith('.gz'):
+            import gzip
+            data = gzip.decompress(data)
+        return data
+
+    def read_atoms(self, uniprot_id, fragment = 1, atom_names = None, residue_names = None):
+        '''Read atom arrays as read_mmcif_atoms() does, or None if there is no such model.'''
+        for format, parse in (('cif', parse_mmcif_atoms), ('pdb', parse_pdb_atoms)):
+            name = self.model_name(uniprot_id, fragment, format)
+            if name is not None:
+                text = self.read_member(name).decode('utf-8')
+                return parse(iter(text.splitlines()), atom_names, residue_names)
+        return None
+
+    def extract_model(self, uniprot_id, fragment = 1, format = 'cif', directory = '.'):
+        '''Write an uncompressed model file, for opening in ChimeraX, and return its path.'''
+        name = self.model_name(uniprot_id, fragment, format)
+        if name is None:
+            return None
+        from os.path import join, basename
+        path = join(directory, basename(name).removesuffix('.gz'))
+        with open(path, 'wb') as file:
+            file.write(self.read_member(name))
+        return path
+
+def tar_member_index(tar_path):
+    '''
+    Map tar member names to (data offset, size).  The index is saved in a JSON file
+    next to the tar file and reused if the tar file size and time have not changed.
+    '''
+    from os.path import getmtime, getsize
+    stamp = [getsize(tar_path), getmtime(tar_path)]
+    index_path = tar_path + '.index.json'
+    import json
+    try:
+        with open(index_path, 'r') as file:
+            saved = json.load(file)
+        if saved['stamp'] == stamp:
+            return {name:tuple(os) for name, os in saved['members'].items()}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import tarfile
+    members = {}
+    with tarfile.open(tar_path, 'r:') as tar:
+        for ti in tar:
+            if ti.isfile():
+                members[ti.name] = (ti.offset_data, ti.size)
+
+    # If the directory is not writable the index is rebuilt next time.
+    save_json(index_path, {'stamp': stamp, 'members': members})
+
+    return members
+
+def save_json(path, data):
+    '''
+    Write a JSON file to a temporary file then rename it so readers never see a
+    partially written file.  Returns False if the file could not be written.
+    '''
+    import json, os
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+def latest_model_versions(filenames):
+    models = {}
+    for filename in filenames:
+        af = parse_alphafold_filename(filename)
+        if af:
+            uniprot_id, fragment, version, format = af
+            key = (uniprot_id, fragment, format)
+            if key not in models or version > models[key][0]:
+                models[key] = (version, filename)
+    return {key:filename for key, (version, filename) in models.items()}
+
+def read_alphafold_atoms(source, uniprot_id, fragment = 1, atom_names = None, residue_names = None):
+    '''
+    Read atoms from an AlphaFold model from a directory of .cif, .cif.gz, .pdb or .pdb.gz
+    files or from a proteome tar file.  The latest model version is used.
+    Returns None if the model is not found.
+    '''
+    if source.endswith('.tar'):
+        return alphafold_archive(source).read_atoms(uniprot_id, fragment, atom_names, residue_names)
+    path = alphafold_model_path(uniprot_id, source, fragment)
+    if path is None:
+        return None
+    from os.path import basename
+    read = read_pdb_atoms if basename(path).endswith(('.pdb', '.pdb.gz')) else read_mmcif_atoms
+    return read(path, atom_names, residue_names)
+
+def read_alphafold_pae(source, uniprot_id, fragment = 1):
+    '''
+    Read the predicted aligned error matrix for an AlphaFold database model
+    from a directory or tar file, or None if there is no PAE file.
+    '''
+    models = alphafold_models(source)
+    name = models.model_name(uniprot_id, fragment, 'pae')
+    if name is None:
+        return None
+    if source.endswith('.tar'):
+        text = models.read_member(name)
+    else:
+        from os.path import join
+        with open_text(join(source, name)) as file:
+            text = file.read()
+    return parse_pae_json(text)
+
+def parse_pae_json(text):
+    # Newer files have a predicted_aligned_error matrix, older files have
+    # residue1, residue2, distance lists.
+    import json
+    pae = json.loads(text)
+    if isinstance(pae, list):
+        pae = pae[0]
+    from numpy import array, float32, empty
+    if 'predicted_aligned_error' in pae:
+        return array(pae['predicted_aligned_error'], float32)
+    r1, r2, d = pae['residue1'], pae['residue2'], pae['distance']
+    n = max(r1)
+    matrix = empty((n,n), float32)
+    matrix[array(r1)-1, array(r2)-1] = d
+    return matrix
+
+def read_alphafold_pae_fragments(source, uniprot_id, fragments, processes = None):
+    '''Read PAE matrices for several fragments in parallel, like read_alphafold_fragments().'''
+    from os import cpu_count
+    if processes is None:
+        processes = min(len(fragments), cpu_count() or 1)
+    alphafold_models(source)	# Make the saved model index before starting worker processes.
+    tasks = [(source, uniprot_id, f) for f in fragments]
+    from afscan import parallel_map
+    return parallel_map(_read_pae_fragment, tasks, processes, chunksize = 1)
+
+def _read_pae_fragment(task):
+    source, uniprot_id, fragment = task
+    return read_alphafold_pae(source, uniprot_id, fragment)
+
+_archives = {}
+def alphafold_archive(tar_path):
+    # Keep opened archives so the member index is read once per process.
+    a = _archives.get(tar_path)
+    if a is None:
+        _archives[tar_path] = a = AlphaFoldArchive(tar_path)
+    return a
+
+def read_alphafold_fragments(source, uniprot_id, fragments, processes = None):
+    '''
+    Read atoms for several fragments of a large AlphaFold model using a pool of
+    processes to decompress and parse the files.  Returns list of atom arrays
+    in the same order as fragments.
+    '''
+    from os import cpu_count
+    if processes is None:
+        processes = min(len(fragments), cpu_count() or 1)
+    alphafold_models(source)	# Make the saved model index before starting worker processes.
+    tasks = [(source, uniprot_id, f) for f in fragments]
+    from afscan import parallel_map
+    return parallel_map(_read_fragment, tasks, processes, chunksize = 1)
+
+def _read_fragment(task):
+    source, uniprot_id, fragment = task
+    return read_alphafold_atoms(source, uniprot_id, fragment)
+
+def alphafold_model_path(uniprot_id, directory, fragment = 1, formats = ('cif', 'pdb')):
+    '''Find latest version model file in a directory, or None if not found.'''
+    manifest = alphafold_manifest(directory)
+    for format in formats:
+        name = manifest.model_name(uniprot_id, fragment, format)
+        if name is not None:
+            from os.path import join
+            return join(directory, name)
+    return None
+
+class AlphaFoldManifest:
+    '''
+    Index of the AlphaFold model files in a directory.  Listing a directory of
+    20,000 files for every model lookup is slow, so the file names are saved in
+    file .alphafold_manifest.json in the directory and only listed again when
+    the directory modification time changes.
+    '''
+    filename = '.alphafold_manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.mtime = None
+        self._models = {}
+        self.update()
+
+    def update(self):
+        '''Reread the directory if files were added, removed or renamed.'''
+        from os import stat
+        mtime = stat(self.directory).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        from os.path import join
+        import json
+        path = join(self.directory, self.filename)
+        try:
+            with open(path, 'r') as file:
+                saved = json.load(file)
+            # Renaming the saved manifest into the directory changes the directory
+            # time, so the manifest is current if the directory has not changed
+            # since the manifest was put in place.
+            current = (saved['mtime'] == mtime or mtime <= stat(path).st_ctime_ns)
+            filenames = saved['filenames'] if current else None
+        except (OSError, ValueError, KeyError):
+            filenames = None
+        if filenames is None:
+            from os import listdir
+            filenames = [f for f in listdir(self.directory) if f.startswith('AF-')]
+            save_json(path, {'mtime': mtime, 'filenames': filenames})
+            mtime = stat(self.directory).st_mtime_ns
+        self.mtime = mtime
+        self._models = latest_model_versions(filenames)
+
+    def uniprot_ids(self):
+        return sorted(set(uniprot_id for uniprot_id, fragment, format in self._models.keys()))
+
+    def num_fragments(self, uniprot_id, format = 'cif'):
+        n = 0
+        while (uniprot_id, n+1, format) in self._models:
+            n += 1
+        return n
+
+    def model_name(self, uniprot_id, fragment = 1, format = 'cif'):
+        return self._models.get((uniprot_id, fragment, format))
+
+_manifests = {}
+def alphafold_manifest(directory):
+    m = _manifests.get(directory)
+    if m is None:
+        _manifests[directory] = m = AlphaFoldManifest(directory)
+    else:
+        m.update()
+    return m
+
+def alphafold_models(source):
+    '''Index of models in an AlphaFold proteome tar file or a directory.'''
+    return alphafold_archive(source) if source.endswith('.tar') else alphafold_manifest(source)
+
+from contextlib import contextmanager
+@contextmanager
+def uncompressed_model_path(source, uniprot_id, fragment = 1, format = 'cif'):
+    '''
+    Context manager giving the path to an uncompressed model file for opening in
+    ChimeraX, or None if there is no such model.  Models from a tar file or gzipped
+    files are written to a temporary directory which is removed on exit.
+
+        with uncompressed_model_path(source, uniprot_id) as path:
+            structures, msg = open_mmcif(session, path)
+    '''
+    if source.endswith('.tar'):
+        a = alphafold_archive(source)
+        if a.model_name(uniprot_id, fragment, format) is None:
+            yield None
+            return
+    else:
+        path = alphafold_model_path(uniprot_id, source, fragment, formats = (format,))
+        if path is None or not path.endswith('.gz'):
+            yield path
+            return
+
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix = 'alphafold_') as directory:
+        if source.endswith('.tar'):
+            upath = a.extract_model(uniprot_id, fragment, format, directory)
+        else:
+            import gzip, shutil
+            from os.path import join, basename
+            upath = join(directory, basename(path).removesuffix('.gz'))
+            with gzip.open(path, 'rb') as fin, open(upath, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+        yield upath
+
+def alphafold_fragment_count(source, uniprot_id):
+    '''Number of fragment files for a model in a directory or tar file.'''
+    models = alphafold_models(source)
+    return max(models.num_fragments(uniprot_id, 'cif'), models.num_fragments(uniprot_id, 'pdb'))
+
+def alphafold_model_mtime(uniprot_id, source, fragment = 1):
+    '''File modification time of a model in a directory or tar file, None if no model.'''
+    from os.path import getmtime
+    if source.endswith('.tar'):
+        a = alphafold_archive(source)
+        found = a.model_name(uniprot_id, fragment, 'cif') or a.model_name(uniprot_id, fragment, 'pdb')
+        return getmtime(source) if found else None
+    path = alphafold_model_path(uniprot_id, source, fragment)
+    return None if path is None else getmtime(path)
+
+def read_pdb_atoms(path, atom_names = None, residue_names = None):
+    '''Read atoms from the first model of a PDB file, returning arrays like read_mmcif_atoms().'''
+    with open_text(path) as file:
+        return parse_pdb_atoms(file, atom_names, residue_names)
+
+def parse_pdb_atoms(lines, atom_names = None, residue_names = None):
+    rows = []
+    for line in lines:
+        if line.startswith('ATOM') or line.startswith('HETATM'):
+            aname, rname = line[12:16].strip(), line[17:20].strip()
+            if ((atom_names is None or aname in atom_names) and
+                (residue_names is None or rname in residue_names)):
+                rows.append((aname, rname, line[21], line[22:26], line[76:78].strip(),
+                             line[30:38], line[38:46], line[46:54], line[60:66]))
+        elif line.startswith('ENDMDL'):
+            break	# Only read the first model
+    return atom_columns(rows)
@@ -0,0 +1,161 @@
+# Cache selected atoms of every AlphaFold model in a proteome in numpy files.
+#
+# Reading 20,000 mmCIF files takes a long time even with several processes.
+# When only the distance cutoff or residue rules of a search change we can instead
+# read the residue numbers, names and coordinates from a few memory mapped numpy
+# arrays.  Each model is keyed by UniProt id and file modification time so models
+# that change are read again when the cache is updated.
+
+class AtomCache:
+    '''
+    Memory mapped atoms for many AlphaFold models, stored in a directory of .npy files.
+    '''
+    arrays = ('residue_number', 'residue_name', 'atom_name', 'chain_id', 'xyz')
+
+    def __init__(self, cache_dir):
+        from os.path import join
+        from numpy import load
+        index = load(join(cache_dir, 'index.npz'))
+        self.uniprot_ids = index['uniprot_ids'].astype(str)
+        self.mtimes = index['mtimes']
+        self.offsets = index['offsets']
+        self.atom_names = tuple(index['atom_names'].astype(str))
+        # Models that could not be read, UniProt id -> error message.
+        self.errors = (dict(zip(index['error_ids'].astype(str).tolist(),
+                                index['error_messages'].astype(str).tolist()))
+                       if 'error_ids' in index.files else {})
+        self._row = {uid:i for i,uid in enumerate(self.uniprot_ids)}
+        self._arrays = {name:load(join(cache_dir, name + '.npy'), mmap_mode = 'r')
+                        for name in self.arrays}
+
+    def __contains__(self, uniprot_id):
+        return uniprot_id in self._row
+
+    def __len__(self):
+        return len(self.uniprot_ids)
+
+    def mtime(self, uniprot_id):
+        i = self._row.get(uniprot_id)
+        return None if i is None else self.mtimes[i]
+
+    def atoms(self, uniprot_id, atom_names = None, residue_names = None):
+        '''
+        Return dictionary of atom arrays like alphafold_files.read_mmcif_atoms()
+        or None if the UniProt id is not in the cache.
+        '''
+        i = self._row.get(uniprot_id)
+        if i is None:
+            return None
+        s,e = self.offsets[i], self.offsets[i+1]
+        atoms = {name:a[s:e] for name,a in self._arrays.items()}
+        atoms['residue_name'] = atoms['residue_name'].astype(str)
+        atoms['atom_name'] = atoms['atom_name'].astype(str)
+        atoms['chain_id'] = atoms['chain_id'].astype(str)
+        if atom_names is not None or residue_names is not None:
+            from numpy import isin, ones
+            mask = ones((e-s,), bool)
+            if atom_names is not None:
+                mask &= isin(atoms['atom_name'], atom_names)
+            if residue_names is not None:
+                mask &= isin(atoms['residue_name'], residue_names)
+            atoms = {name:a[mask] for name,a in atoms.items()}
+        return atoms
+
+def build_atom_cache(cache_dir, uniprot_ids, alphafold_dir,
+                     atom_names = ('CA', 'SG'), processes = None, save_every = 1000):
+    '''
+    Create or update the cache for the given UniProt ids.  Models already
+    cached with an unchanged file modification time are not read again, and
+    cached models not in uniprot_ids are kept so a later search using other
+    models does not read them again.  Models that cannot be read are reported,
+    recorded in the cache errors and tried again on the next update.  The cache
+    is saved after every save_every newly read models so an interrupted update
+    keeps the models already read.
+    '''
+    from os.path import join, exists
+    old = None
+    if exists(join(cache_dir, 'index.npz')):
+        old = AtomCache(cache_dir)
+        if old.atom_names != tuple(atom_names):
+            old = None	# Different atoms cached, rebuild everything.
+
+    from afscan import parallel_imap
+    from alphafold_files import alphafold_model_mtime	# Also makes the model index for workers.
+    order = [] if old is None else old.uniprot_ids.tolist()
+    order.extend(uid for uid in uniprot_ids if old is None or uid not in old)
+    mtimes, parts, read_ids, tasks = {}, {}, [], []
+    requested = set(uniprot_ids)
+    for uniprot_id in order:
+        mtime = alphafold_model_mtime(uniprot_id, alphafold_dir)
+        if mtime is None:
+            continue
+        mtimes[uniprot_id] = mtime
+        if old is not None and old.mtime(uniprot_id) == mtime:
+            parts[uniprot_id] = old.atoms(uniprot_id)
+        elif uniprot_id in requested:
+            read_ids.append(uniprot_id)
+            tasks.append((alphafold_dir, uniprot_id, tuple(atom_names)))
+    # Keep errors of models not read in this update so they are not reported missing.
+    errors = {} if old is None else {uid:msg for uid,msg in old.errors.items()
+                                     if uid not in requested}
+    old = None	# Release memory mapped files before overwriting them.
+
+    unsaved = 0
+    for uniprot_id, (status, value) in zip(read_ids, parallel_imap(_read_cache_atoms, tasks, processes)):
+        if status == 'error':
+            print(f'Skipped AlphaFold model {uniprot_id}: {value}')
+            errors[uniprot_id] = value
+            continue
+        parts[uniprot_id] = value
+        unsaved += 1
+        if unsaved >= save_every:
+            _save_cache(cache_dir, [uid for uid in order if uid in parts], mtimes, parts, atom_names, errors)
+            unsaved = 0
+
+    return _save_cache(cache_dir, [uid for uid in order if uid in parts], mtimes, parts, atom_names, errors)
+
+cache_types = {'residue_number': 'int32', 'residue_name': 'S3', 'atom_name': 'S4',
+               'chain_id': 'S4', 'xyz': 'float32'}
+
+def _save_cache(cache_dir, ids, mtimes, parts, atom_names, errors = None):
+    '''
+    Write the atoms for the given ids to the cache files.  The parts dictionary
+    is refilled with arrays memory mapped from the new files.
+    '''
+    from os.path import join
+    from numpy import concatenate, cumsum, array, save, savez, float64, int64
+    offsets = cumsum([0] + [len(parts[uid]['residue_number']) for uid in ids], dtype = int64)
+    merged = {name:concatenate([parts[uid][name] for uid in ids]).astype(cache_types[name])
+              if ids else array([], cache_types[name]) for name in AtomCache.arrays}
+    if len(ids) == 0:
+        merged['xyz'] = merged['xyz'].reshape((0,3))
+    parts.clear()	# Release memory mapped files before overwriting them.
+
+    import os
+    os.makedirs(cache_dir, exist_ok = True)
+    for name, a in merged.items():
+        tmp_path = join(cache_dir, name + '.tmp.npy')
+        save(tmp_path, a)
+        os.replace(tmp_path, join(cache_dir, name + '.npy'))
+    tmp_path = join(cache_dir, 'index.tmp.npz')
+    savez(tmp_path, uniprot_ids = array(ids, str), mtimes = array([mtimes[uid] for uid in ids], float64),
+          offsets = offsets, atom_names = array(atom_names, str),
+          error_ids = array(list(errors or ()), str), error_messages = array(list((errors or {}).values()), str))
+    os.replace(tmp_path, join(cache_dir, 'index.npz'))
+
+    cache = AtomCache(cache_dir)
+    parts.update((uid, cache.atoms(uid)) for uid in ids)
+    return cache
+
+def _read_cache_atoms(task):
+    alphafold_dir, uniprot_id, atom_names = task
+    try:
+        from alphafold_files import read_alphafold_atoms
+        atoms = read_alphafold_atoms(alphafold_dir, uniprot_id, atom_names = atom_names)
+        if atoms is None:
+            return ('error', 'model file not found')
+        # Convert types here so a bad value is reported for this model only.
+        atoms = {name:atoms[name].astype(cache_types[name]) for name in AtomCache.arrays}
+    except Exception as e:
+        return ('error', f'{type(e).__name__}: {e}')
+    return ('ok', atoms)
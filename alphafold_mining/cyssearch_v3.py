@@ -2,69 +2,42 @@
 # Can use UniProt to identify transmembrane residues, then use AlphaFold database predicted structures
 # to see if there are close cysteines.
 
-def find_uniprot_transmembrane_cysteines(uniprot_xml_path, namespace = '{http://uniprot.org/uniprot}'):
-    import xml.etree.ElementTree as ET
-    tree = ET.parse(uniprot_xml_path)
-    tm = []
-    for child in tree.getroot():
-        if child.tag == namespace + 'entry':
-            rr = transmembrane_residue_ranges(child, namespace)
-            uniprot_id = child.find(namespace + 'accession').text
-            seq = child.find(namespace + 'sequence').text
-            full_name = child.find(f'./{namespace}protein/{namespace}submittedName/{namespace}fullName')
-            name = '' if full_name is None else full_name.text
-            phc = paired_helix_cys(seq, rr)
-            tm.append((uniprot_id, name, phc, rr))
+# Helper modules proteome.py, afscan.py, atom_cache.py and alphafold_files.py must be in the same directory as this script.
+import sys
+from os.path import dirname, abspath
+sys.path.insert(0, dirname(abspath(__file__)))
+
+def find_uniprot_transmembrane_cysteines(uniprot_xml_path):
+    # The proteome index is read once from the .xml or .xml.gz file and saved
+    # in a .index.npz file for fast rereading.
+    from proteome import proteome_index
+    index = proteome_index(uniprot_xml_path)
+    proteins = range(index.num_proteins)
+    phc = paired_helix_cys(index, proteins)
+    tm = [(uniprot_id, name, phc[p], index.segment_ranges(p))
+          for p, uniprot_id, name in zip(proteins, index.uniprot_ids.tolist(), index.names.tolist())]
     return tm
 
-def paired_helix_cys(seq, rr):
-    # Dengke suggests considering only paired cysteines CC, CxC or CxxC in a helix.
-    phc = []
-    for b,e in rr:
-        ci = set([i+1 for i in range(b-1,e) if seq[i] == 'C'])
-        pci = [i for i in ci
-               if ((i+1) in ci or (i+2) in ci or (i+3) in ci or
-                   (i-1) in ci or (i-2) in ci or (i-3) in ci)]
-        if len(pci) >= 2:
-            phc.append(pci)
-    return phc
-
-def transmembrane_residue_ranges(protein_xml_entry, namespace):
-    ranges = []
-    for feature in protein_xml_entry.iter(namespace + 'feature'):
-        fattrib = feature.attrib
-        if 'type' in fattrib and fattrib['type'] == 'transmembrane region':
-            for loc in feature.iter(namespace + 'location'):
-                b,e = loc.find(namespace + 'begin'), loc.find(namespace + 'end')
-                if b is not None and e is not None:
-                    if 'position' in b.attrib and 'position' in e.attrib:
-                        r = (int(b.attrib['position']), int(e.attrib['position']))
-                        ranges.append(r)
-    return ranges
+# Dengke suggests considering only paired cysteines CC, CxC or CxxC in a helix.
+helix_feature = 'transmembrane region'
+max_gap = 3
+min_paired = 2
+
+def paired_helix_cys(index, proteins):
+    return index.paired_residue_groups(proteins, 'C', max_gap = max_gap, min_paired = min_paired,
+                                       feature = helix_feature)
 
 def close_cysteines(structure, membrane_residue_ranges, max_distance = 5):
-    cys_res = [r for r in structure.residues if r.name == 'CYS']
-    cys_xyz = [(r.number, r.find_atom('SG').coord) for r in cys_res]
-    mb_res_nums = residue_numbers_from_ranges(membrane_residue_ranges)
-    mb_cys = [r for r in cys_res if r.number in mb_res_nums]
-    mb_xyz = [(r.number, r.find_atom('SG').coord) for r in mb_cys]
-
-    close_pairs = set()
-    from chimerax.geometry import distance
-    for rnum, xyz in mb_xyz:
-        for rnum2, xyz2 in cys_xyz:
-            if rnum2 != rnum and distance(xyz, xyz2) <= max_distance:
-                pair = (rnum, rnum2) if rnum < rnum2 else (rnum2, rnum)
-                close_pairs.add(pair)
-
-    return list(close_pairs)
-
-def atoms_by_residue_number(atoms, atom_name):
-    amap = {}
-    for a in atoms:
-        if a.name == atom_name:
-            amap[a.residue.number] = a
-    return amap
+    from afscan import close_cysteines
+    return close_cysteines(structure_atom_arrays(structure), membrane_residue_ranges, max_distance)
+
+def structure_atom_arrays(structure):
+    # Atom arrays used by the fast close pair search in afscan.py
+    atoms = structure.atoms
+    residues = atoms.residues
+    return {'atom_name': atoms.names, 'residue_name': residues.names,
+            'chain_id': residues.chain_ids, 'residue_number': residues.numbers,
+            'xyz': atoms.coords}
 
 def residue_numbers_from_ranges(residue_ranges):
     res_nums = set()
@@ -73,7 +46,16 @@ def residue_numbers_from_ranges(residue_ranges):
             res_nums.add(rnum)
     return res_nums
 
-def check_for_close_cysteines(session, ulist, alphafold_dir, max_distance):
+def check_for_close_cysteines(session, ulist, alphafold_dir, max_distance,
+                              processes = None, open_structures = False, cache = None,
+                              results_path = None, parameters = None):
+    if not open_structures:
+        # Read only cysteine SG coordinates using a pool of processes, or from a cache.
+        # Results are saved as they are computed to resume an interrupted scan.
+        from afscan import scan_for_close_cysteines
+        return scan_for_close_cysteines(ulist, alphafold_dir, max_distance, processes, cache,
+                                        results_path, parameters)
+
     found = []
     missing = []
     for uniprot_id, name, paired_hel_cys, tm_res_ranges in ulist:
@@ -83,28 +65,22 @@ def check_for_close_cysteines(session, ulist, alphafold_dir, max_distance):
         if m is None:
             missing.append((uniprot_id, name))
             continue
-        close_pairs = []
-        atoms = atoms_by_residue_number(m.atoms, 'SG')
-        from chimerax.geometry import distance
-        for i,ph1 in enumerate(paired_hel_cys):
-            for ph2 in paired_hel_cys[i+1:]:
-                for rnum1 in ph1:
-                    for rnum2 in ph2:
-                        if distance(atoms[rnum1].coord, atoms[rnum2].coord) <= max_distance:
-                            close_pairs.append((rnum1, rnum2))
+        from afscan import helix_pair_close_cysteines
+        close_pairs = helix_pair_close_cysteines(structure_atom_arrays(m), paired_hel_cys, max_distance)
         if close_pairs:
             found.append((uniprot_id, name, close_pairs, tm_res_ranges))
         m.delete()
     return found, missing
 
 def alphafold_database_model(session, uniprot_id, alphafold_dir):
-    filename = f'AF-{uniprot_id}-F1-model_v4.cif'
-    from os.path import join, exists
-    path = join(alphafold_dir, filename)
-    if not exists(path):
-        return None
-    from chimerax.mmcif import open_mmcif
-    s, msg = open_mmcif(session, path)
+    # Models can be .cif or .cif.gz in a directory or in a proteome tar file.
+    # Decompressed files are in a temporary directory removed after opening.
+    from alphafold_files import uncompressed_model_path
+    with uncompressed_model_path(alphafold_dir, uniprot_id) as path:
+        if path is None:
+            return None
+        from chimerax.mmcif import open_mmcif
+        s, msg = open_mmcif(session, path)
     return s[0]
 
 def open_entries(session, entries, alphafold_dir):
@@ -120,8 +96,17 @@ def open_entries(session, entries, alphafold_dir):
     session.models.add(models)
     
 uniprot_xml_path = 'UP000001940_6239.xml'
-alphafold_dir = 'alphafold_models'
+alphafold_dir = 'alphafold_models'	# Directory of models or proteome tar file
 max_distance = 10
+processes = None	# Number of processes to read AlphaFold models, default number of cores.
+atom_cache_dir = 'alphafold_atom_cache'	# Cache of CA and SG atoms, None for no cache.
+results_path = f'cyssearch_{max_distance}A.csv'	# Resume scan from this file, None to not save.
+
+# A scan is only resumed from a results file made with the same parameters.
+from os.path import abspath
+scan_parameters = {'uniprot_xml_path': abspath(uniprot_xml_path), 'alphafold_dir': abspath(alphafold_dir),
+                   'feature': helix_feature, 'max_gap': max_gap, 'min_paired': min_paired,
+                   'max_distance': max_distance}
 
 ulist = find_uniprot_transmembrane_cysteines(uniprot_xml_path)
 print(f'{len(ulist)} UniProt entries')
@@ -133,7 +118,16 @@ ntm4p = len([uniprot_id for uniprot_id, name, paired_hel_cys, tm_res_ranges in u
              if len(tm_res_ranges)>=4 and len(paired_hel_cys)>=2])
 print(f'{ntm4p} entries with 4 or more transmembrane helices and at least two with CC, CxC or CxxC cysteine pairs')
 
-uclose, missing = check_for_close_cysteines(session, ulist, alphafold_dir, max_distance)
+cache = None
+if atom_cache_dir:
+    # Reads new or changed AlphaFold models, then later runs use the cached atoms.
+    from atom_cache import build_atom_cache
+    cache = build_atom_cache(atom_cache_dir, [u[0] for u in ulist if len(u[2]) >= 2],
+                             alphafold_dir, processes = processes)
+
+uclose, missing = check_for_close_cysteines(session, ulist, alphafold_dir, max_distance,
+                                            processes, cache = cache, results_path = results_path,
+                                            parameters = scan_parameters)
 print(f'{len(uclose)} with paired cysteines in two helices closer than {max_distance}A')
 
 entries = []
@@ -0,0 +1,252 @@
+# Read UniProt proteome XML files one entry at a time.
+#
+# The UniProt reference proteome XML files are large (193 Mbytes for C elegans,
+# several Gbytes for human or TrEMBL) so parsing the whole file into an element
+# tree takes minutes and gigabytes of memory.  Here we use iterparse() and discard
+# each <entry> after it is read so memory use does not grow with proteome size.
+# Gzip compressed .xml.gz files are read directly.
+
+uniprot_namespace = '{http://uniprot.org/uniprot}'
+
+def uniprot_entries(uniprot_xml_path, feature_types = ('transmembrane region',),
+                    namespace = uniprot_namespace):
+    '''
+    Yield (uniprot_id, name, sequence, feature_ranges) for each entry in a UniProt
+    XML file where feature_ranges maps each feature type to a list of residue
+    number ranges (first, last).
+    '''
+    for entry in uniprot_entry_elements(uniprot_xml_path, namespace):
+        uniprot_id = entry.find(namespace + 'accession').text
+        seq = entry.find(namespace + 'sequence').text
+        full_name = entry.find(f'./{namespace}protein/{namespace}submittedName/{namespace}fullName')
+        name = '' if full_name is None else full_name.text
+        ranges = {feature:feature_residue_ranges(entry, feature, namespace) for feature in feature_types}
+        yield (uniprot_id, name, seq, ranges)
+
+def uniprot_entry_elements(uniprot_xml_path, namespace = uniprot_namespace):
+    '''
+    Yield each <entry> XML element.  The element is cleared after the caller
+    has processed it so only one entry is held in memory at a time.
+    '''
+    import xml.etree.ElementTree as ET
+    entry_tag = namespace + 'entry'
+    with open_text_or_gzip(uniprot_xml_path) as file:
+        root = None
+        for event, elem in ET.iterparse(file, events = ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+            elif elem.tag == entry_tag:
+                yield elem
+                # Remove the entry from the root so the tree does not grow.
+                root.clear()
+
+def open_text_or_gzip(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def feature_residue_ranges(protein_xml_entry, feature_type, namespace = uniprot_namespace):
+    ranges = []
+    for feature in protein_xml_entry.iter(namespace + 'feature'):
+        fattrib = feature.attrib
+        if 'type' in fattrib and fattrib['type'] == feature_type:
+            for loc in feature.iter(namespace + 'location'):
+                b,e = loc.find(namespace + 'begin'), loc.find(namespace + 'end')
+                if b is not None and e is not None:
+                    if 'position' in b.attrib and 'position' in e.attrib:
+                        r = (int(b.attrib['position']), int(e.attrib['position']))
+                        ranges.append(r)
+    return ranges
+
+class ProteomeIndex:
+    '''
+    All sequences of a proteome packed into one numpy byte array with residue
+    ranges of UniProt features (transmembrane region, helix) so that sequence
+    motif rules can be evaluated for the whole proteome with array operations.
+    '''
+    def __init__(self, uniprot_ids, names, sequences, offsets, segments):
+        self.uniprot_ids = uniprot_ids	# numpy string array
+        self.names = names		# numpy string array
+        self.sequences = sequences	# numpy uint8 array, all sequences concatenated
+        self.offsets = offsets		# start of each sequence, length num proteins + 1
+        # Map feature type to (protein index, start, end) arrays.  Start and end are
+        # indices into the sequences array with end one past the last residue.
+        self.segments = segments
+        self._segment_residues = {}
+
+    @property
+    def num_proteins(self):
+        return len(self.uniprot_ids)
+
+    def segment_ranges(self, protein, feature = 'transmembrane region'):
+        '''Residue number ranges (first, last) of a feature for one protein.'''
+        sp, ss, se = self.segments[feature]
+        from numpy import searchsorted
+        s0, s1 = searchsorted(sp, (protein, protein+1))	# Segments are ordered by protein
+        o = int(self.offsets[protein])
+        return [(b-o+1, e-o) for b,e in zip(ss[s0:s1].tolist(), se[s0:s1].tolist())]
+
+    def segment_residues(self, feature = 'transmembrane region'):
+        '''
+        Segment index and sequences array index for every residue of every segment,
+        ordered by segment.  Residues in overlapping segments appear once for each
+        segment, so each segment is treated separately as in paired_helix_cys().
+        '''
+        sr = self._segment_residues.get(feature)
+        if sr is None:
+            from numpy import int32, arange, repeat, maximum
+            sp, ss, se = self.segments[feature]
+            lengths = maximum(se - ss, 0)
+            seg = repeat(arange(len(ss), dtype = int32), lengths)
+            res = repeat(ss - lengths.cumsum() + lengths, lengths) + arange(lengths.sum())
+            self._segment_residues[feature] = sr = (seg, res)
+        return sr
+
+    def residue_mask(self, feature = 'transmembrane region'):
+        from numpy import zeros
+        mask = zeros((len(self.sequences),), bool)
+        mask[self.segment_residues(feature)[1]] = True
+        return mask
+
+    def residue_counts(self, residue = 'C', feature = 'transmembrane region'):
+        '''Number of residues of the given type in each segment.'''
+        seg, res = self.segment_residues(feature)
+        match = (self.sequences[res] == ord(residue))
+        from numpy import bincount
+        return bincount(seg[match], minlength = len(self.segments[feature][0]))
+
+    def _paired_segment_residues(self, residue = 'C', max_gap = 3, feature = 'transmembrane region'):
+        # Mask over segment_residues() of residues paired within the same segment.
+        seg, res = self.segment_residues(feature)
+        match = (self.sequences[res] == ord(residue))
+        from numpy import zeros_like
+        paired = zeros_like(match)
+        for g in range(1, max_gap+1):
+            p = match[:-g] & match[g:] & (seg[:-g] == seg[g:])
+            paired[:-g] |= p
+            paired[g:] |= p
+        return seg, res, paired
+
+    def paired_residues(self, residue = 'C', max_gap = 3, feature = 'transmembrane region'):
+        '''
+        Mask of residues of the given type that have another residue of that type at
+        most max_gap positions away in the same segment, e.g. CC, CxC, CxxC for max_gap 3.
+        '''
+        seg, res, paired = self._paired_segment_residues(residue, max_gap, feature)
+        from numpy import zeros
+        mask = zeros((len(self.sequences),), bool)
+        mask[res[paired]] = True
+        return mask
+
+    def paired_residue_counts(self, residue = 'C', max_gap = 3, feature = 'transmembrane region'):
+        '''Number of paired residues in each segment.'''
+        seg, res, paired = self._paired_segment_residues(residue, max_gap, feature)
+        from numpy import bincount
+        return bincount(seg[paired], minlength = len(self.segments[feature][0]))
+
+    def protein_segment_counts(self, segment_mask, feature = 'transmembrane region'):
+        '''Number of segments in each protein where segment_mask is true.'''
+        sp = self.segments[feature][0]
+        from numpy import bincount
+        return bincount(sp[segment_mask], minlength = self.num_proteins)
+
+    def protein_max(self, segment_values, feature = 'transmembrane region'):
+        '''Maximum segment value for each protein, 0 if no segments.'''
+        from numpy import zeros, maximum
+        pmax = zeros((self.num_proteins,), segment_values.dtype)
+        maximum.at(pmax, self.segments[feature][0], segment_values)
+        return pmax
+
+    def paired_residue_groups(self, proteins, residue = 'C', max_gap = 3, min_paired = 2,
+                              feature = 'transmembrane region'):
+        '''
+        For each protein index return lists of residue numbers of paired residues for
+        each segment with at least min_paired paired residues, like paired_helix_cys()
+        in cyssearch_v3.py.
+        '''
+        seg, res, paired = self._paired_segment_residues(residue, max_gap, feature)
+        seg_ok = self.paired_residue_counts(residue, max_gap, feature) >= min_paired
+        keep = paired & seg_ok[seg]
+        seg, res = seg[keep], res[keep]
+        from numpy import split, diff, concatenate
+        breaks = (diff(seg) != 0).nonzero()[0] + 1
+        seg_res = zip(seg[concatenate(([0], breaks))].tolist(), split(res, breaks)) if len(res) else []
+        sp = self.segments[feature][0]
+        groups = {p:[] for p in proteins}
+        for si, r in seg_res:
+            p = int(sp[si])
+            if p in groups:
+                groups[p].append((r - self.offsets[p] + 1).tolist())
+        return [groups[p] for p in proteins]
+
+    def save(self, path):
+        # Write a temporary file and rename it so an interrupted save never
+        # leaves a truncated index.
+        from numpy import savez, array
+        seg = {}
+        for i,(feature, (sp, ss, se)) in enumerate(self.segments.items()):
+            seg[f'segment_protein_{i}'], seg[f'segment_start_{i}'], seg[f'segment_end_{i}'] = sp, ss, se
+        import os
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        try:
+            savez(tmp_path, uniprot_ids = self.uniprot_ids, names = self.names,
+                  sequences = self.sequences, offsets = self.offsets,
+                  features = array(list(self.segments.keys()), str), **seg)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        from numpy import load
+        f = load(path)
+        segments = {feature:(f[f'segment_protein_{i}'], f[f'segment_start_{i}'], f[f'segment_end_{i}'])
+                    for i,feature in enumerate(f['features'].tolist())}
+        return cls(f['uniprot_ids'], f['names'], f['sequences'], f['offsets'], segments)
+
+def proteome_index(uniprot_xml_path, feature_types = ('transmembrane region', 'helix'),
+                   namespace = uniprot_namespace):
+    '''
+    Read a UniProt XML proteome file into a ProteomeIndex.  The index is saved in a
+    file next to the XML file with suffix .index.npz and is reused if it is newer than
+    the XML file.
+    '''
+    index_path = uniprot_xml_path + '.index.npz'
+    from os.path import exists, getmtime
+    if exists(index_path) and getmtime(index_path) >= getmtime(uniprot_xml_path):
+        try:
+            index = ProteomeIndex.load(index_path)
+        except Exception:
+            index = None	# Unreadable index file, rebuild it.
+        if index is not None and set(feature_types).issubset(index.segments.keys()):
+            return index
+
+    ids, names, seqs, offsets = [], [], bytearray(), [0]
+    seg = {feature:([],[],[]) for feature in feature_types}
+    entries = uniprot_entries(uniprot_xml_path, feature_types, namespace)
+    for p, (uniprot_id, name, seq, feature_ranges) in enumerate(entries):
+        ids.append(uniprot_id)
+        names.append(name)
+        o = len(seqs)
+        seqs.extend(seq.encode('ascii'))
+        offsets.append(len(seqs))
+        for feature, ranges in feature_ranges.items():
+            sp, ss, se = seg[feature]
+            for b,e in ranges:
+                sp.append(p)
+                ss.append(o + b - 1)
+                se.append(o + e)
+
+    from numpy import array, frombuffer, uint8, int32, int64
+    segments = {feature:(array(sp, int32), array(ss, int64), array(se, int64))
+                for feature, (sp, ss, se) in seg.items()}
+    index = ProteomeIndex(array(ids, str), array(names, str), frombuffer(bytes(seqs), uint8),
+                          array(offsets, int64), segments)
+    try:
+        index.save(index_path)
+    except OSError:
+        pass	# Directory not writable, index is rebuilt next time.
+    return index
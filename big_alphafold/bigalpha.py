@@ -1,11 +1,11 @@
 #
 # Open AlphaFold database models for proteins larger than 1400 amino acids.
 # These calculated in 1400 amino acid segments every 200 amino acids due to
-# limitations (GPU memory) of the AlphaFold software.  We load and align
-# the segment models.  This produces many clashes.
+# limitations (GPU memory) of the AlphaFold software.  We read the segment
+# coordinates, align them and remove the overlaps, then make a single structure.
+# This produces many clashes.
 #
-# Opening this Python in ChimeraX (version newer than August 2021 because it
-# uses the new combine command) will register the "bigalpha" command.
+# Opening this Python in ChimeraX will register the "bigalpha" command.
 # You need to have downloaded the human AlphaFold database models from
 #
 #	 https://alphafold.ebi.ac.uk/download
@@ -15,60 +15,92 @@
 #  cd /directory/of/alphafold/models
 #  bigalpha Q8WZ42
 #
+# The directory can also be the downloaded proteome tar file, for example
+#
+#  bigalpha Q8WZ42 directory UP000005640_9606_HUMAN_v4.tar
+#
+# Reading the model files uses alphafold_files.py and afscan.py from the
+# alphafold_mining recipe directory next to the big_alphafold directory.
+# The segment files are read in parallel using the number of processes given
+# by the processes option, default one per segment up to the number of cores.
+# If those files are not found the segment files in a directory are opened
+# one at a time with ChimeraX, and tar files and PAE are not supported.
+#
+# With option "pae true" the segment predicted aligned error files are also read
+# and kept as blocks along the diagonal of the full length PAE matrix, which for
+# titin would need 5 Gbytes as a dense matrix.  The PAE plot is shown with
+#
+#  bigalpha pae #1
+#
+
 def open_multifile_alphafold_model(session, uniprot_id = 'Q8WZ42', directory = '.',
                                    combine = True, residues_per_file = 1400,
-                                   overlap = 200, align_span = 5):
+                                   overlap = 200, align_span = 5, processes = None,
+                                   pae = False):
     # Allow multiple UniProt identifiers comma-separated.
     if ',' in uniprot_id:
         # Handle multiple uniprot ids
         models = []
         for uid in uniprot_id.split(','):
             m = open_multifile_alphafold_model(session, uid, directory, combine,
-                                               residues_per_file, overlap)
+                                               residues_per_file, overlap, align_span,
+                                               processes, pae)
             models.extend(m)
         return models
 
     # Find the AlphaFold structure files for this UniProt identifier.
-    from os import listdir
-    all_filenames = listdir(directory)
-    filenames = [filename for filename in all_filenames
-                 if filename.startswith('AF-%s' % uniprot_id)
-                    and filename.endswith('.pdb.gz')]
-    nfiles = len(filenames)
-    print ('AlphaFold %s is split into %d mmCIF files' % (uniprot_id, nfiles))
-    # Cannot read compressed mmCIF directly
-    # filename = 'AF-%s-F%%d-model_v1.cif.gz' % uniprot_id
-    filename = 'AF-%s-F%%d-model_v1.pdb.gz' % uniprot_id
-
-    # Find the next available model number
-    model_id = max([m.id[0] for m in session.models], default = 0) + 1
-
-    # Open the overlapping component models.
-    models = []
-    fstep = (residues_per_file // overlap) - 1
-    for i in range(1,nfiles+1,fstep):
-        open_next_model(filename % i,
-                        residues_per_file, overlap, align_span, models)
+    af_files = alphafold_files_module()
+    if af_files is None:
+        nfiles = fragment_count(directory, uniprot_id)
+    else:
+        nfiles = af_files.alphafold_fragment_count(directory, uniprot_id)
+    from chimerax.core.errors import UserError
+    if nfiles == 0:
+        raise UserError('No AlphaFold model files for %s in %s' % (uniprot_id, directory))
+    print ('AlphaFold %s is split into %d files' % (uniprot_id, nfiles))
 
-    # Add last model which may overlap by a different number of residues.
-    if (nfiles-1) % fstep != 0:
-        last_overlap = overlap + overlap*(fstep - ((nfiles-1) % fstep))
-        open_next_model(filename % nfiles,
-                        residues_per_file, last_overlap, align_span, models)
+    # Read the coordinates of the overlapping segments in parallel processes.
+    fragments = segment_fragments(nfiles, residues_per_file, overlap)
+    if af_files is None:
+        segments = open_segments(session, directory, uniprot_id, fragments)
+    else:
+        segments = af_files.read_alphafold_fragments(directory, uniprot_id, fragments, processes)
+    missing = [f for f, atoms in zip(fragments, segments) if atoms is None]
+    if missing:
+        raise UserError('AlphaFold %s is missing model files for fragments %s'
+                        % (uniprot_id, ', '.join('F%d' % f for f in missing)))
 
-    # Combine the segment models into one
-    model_ids = '#' + ','.join(m.id_string for m in models)
-    from chimerax.core.commands import run
+    # Align each segment to the previous one and trim the overlap.
+    pieces = stitch_segments(segments, fragments, overlap, align_span)
+
+    # Make a single structure, or one structure per segment grouped under a parent model.
     if combine:
-        # Combine into one model
-        shift_residue_numbers(models)
-        copy = run(session, ('combine %s name %s modelId #%d close true'
-                             % (model_ids, uniprot_id, model_id)))
-        models = [copy]
-        # TODO: Currently the combine command cannot preserve chain ids.
+        models = [structure_from_atoms(session, concatenate_atoms(pieces), uniprot_id)]
+        session.models.add(models)
     else:
-        # Group models under a parent model
-        run(session, 'rename %s %s id #%d' % (model_ids, uniprot_id, model_id))
+        models = [structure_from_atoms(session, piece, '%s F%d' % (uniprot_id, f))
+                  for piece, f in zip(pieces, fragments)]
+        session.models.add_group(models, name = uniprot_id)
+
+    # Read the segment PAE matrices and attach the stitched PAE to the structure.
+    if pae:
+        if af_files is None:
+            raise UserError('Reading PAE needs alphafold_files.py from the alphafold_mining recipe')
+        matrices = af_files.read_alphafold_pae_fragments(directory, uniprot_id, fragments, processes)
+        if None in matrices:
+            session.logger.warning('No PAE files found for AlphaFold %s' % uniprot_id)
+        elif combine:
+            starts = [(f-1)*overlap for f in fragments]
+            models[0].bigalpha_pae = StitchedPAE(matrices, starts)
+        else:
+            for m, matrix in zip(models, matrices):
+                m.bigalpha_pae = StitchedPAE([matrix], [0])
+
+    from chimerax.core.commands import run
+    for m in models:
+        id = m.id_string
+        run(session, 'color bfactor #%s palette alphafold' % id)
+        run(session, 'hide #%s cartoon ; show #%s atoms ; style #%s sphere' % (id,id,id))
 
     # Adjust lighting and center view.
     run(session, 'light full')
@@ -76,40 +108,242 @@ def open_multifile_alphafold_model(session, uniprot_id = 'Q8WZ42', directory = '
     
     return models
 
-def open_next_model(path, residues_per_file, overlap, align_span, models):
-    from chimerax.core.commands import run
-    model = run(session, 'open %s' % path)[0]
-    id = model.id_string
-    run(session, 'color bfactor #%s palette alphafold' % id)
-    run(session, 'hide #%s cartoon ; show #%s atoms ; style #%s sphere' % (id,id,id))
-
-    end_match = '%d-%d' % (residues_per_file-5, residues_per_file-1)  # 1395-1399
-    if models:
-        last_model = models[-1]
-        run(session, 'align #%s:%d-%d@CA to #%s:%s@CA'
-            % (model.id_string, overlap-align_span+1, overlap,
-               last_model.id_string, end_match))
-        run(session, 'delete #%s:1-%d' % (model.id_string, overlap))
-
-    models.append(model)
-
-def shift_residue_numbers(structures):
-    # First adjust residue numbers of each segment
-    rnext = 1
-    for i,m in enumerate(structures):
-        rnums = m.residues.numbers
-        rmax, rmin = rnums.max(), rnums.min()
-        m.residues.numbers += rnext - rmin
-        rnext += rmax-rmin+1
+def alphafold_files_module():
+    '''The alphafold_mining recipe model reader, or None if it is not found.'''
+    import sys
+    from os.path import dirname, abspath, join
+    mining_dir = join(dirname(dirname(abspath(__file__))), 'alphafold_mining')
+    if mining_dir not in sys.path:
+        sys.path.insert(0, mining_dir)
+    try:
+        import alphafold_files
+    except ImportError:
+        return None
+    return alphafold_files
+
+def fragment_count(directory, uniprot_id):
+    '''Number of segment files for a UniProt id in a directory, without alphafold_files.py.'''
+    from chimerax.core.errors import UserError
+    if directory.endswith('.tar'):
+        raise UserError('Reading tar files needs alphafold_files.py from the alphafold_mining recipe')
+    from os import listdir
+    import re
+    pattern = re.compile(r'AF-%s-F(\d+)-model_v\d+\.(cif|pdb)(\.gz)?$' % re.escape(uniprot_id))
+    fragments = set(m.group(1) for m in map(pattern.match, listdir(directory)) if m)
+    return len(fragments)
+
+def open_segments(session, directory, uniprot_id, fragments):
+    '''Open segment files one at a time with ChimeraX and return their atom arrays.'''
+    from os import listdir
+    from os.path import join
+    from chimerax.core.commands import run, quote_if_necessary
+    filenames = sorted(listdir(directory))
+    segments = []
+    for f in fragments:
+        prefix = 'AF-%s-F%d-model_v' % (uniprot_id, f)
+        paths = [join(directory, filename) for filename in filenames if filename.startswith(prefix)]
+        if len(paths) == 0:
+            segments.append(None)
+            continue
+        s = run(session, 'open %s' % quote_if_necessary(paths[-1]), log = False)[0]
+        atoms = s.atoms
+        residues = atoms.residues
+        segments.append({'atom_name': atoms.names, 'element': atoms.element_names,
+                         'residue_name': residues.names, 'chain_id': residues.chain_ids,
+                         'residue_number': residues.numbers, 'xyz': atoms.coords,
+                         'bfactor': atoms.bfactors})
+        s.delete()
+    return segments
+
+def segment_fragments(nfiles, residues_per_file = 1400, overlap = 200):
+    # Use every sixth fragment since fragments start every 200 residues,
+    # and add the last fragment which may overlap by a different number of residues.
+    fstep = (residues_per_file // overlap) - 1
+    fragments = list(range(1, nfiles+1, fstep))
+    if (nfiles-1) % fstep != 0:
+        fragments.append(nfiles)
+    return fragments
+
+def stitch_segments(segments, fragments, overlap = 200, align_span = 5):
+    '''
+    Renumber segment residues to full sequence numbering, superimpose the C-alpha
+    atoms of the last align_span residues of each previous segment and remove
+    the residues already in the previous segment.  Returns the trimmed atom arrays.
+    '''
+    pieces = []
+    last_end = 0
+    for atoms, f in zip(segments, fragments):
+        atoms = dict(atoms)
+        atoms['residue_number'] = atoms['residue_number'] + (f-1)*overlap
+        rnum = atoms['residue_number']
+        if pieces:
+            align_rnums = range(last_end - align_span + 1, last_end + 1)
+            xyz_from = _ca_coords(atoms, align_rnums)
+            xyz_to = _ca_coords(pieces[-1], align_rnums)
+            rot, shift = superposition(xyz_from, xyz_to)
+            atoms['xyz'] = atoms['xyz'] @ rot.T + shift
+            keep = (rnum > last_end)
+            atoms = {name:a[keep] for name,a in atoms.items()}
+        pieces.append(atoms)
+        last_end = atoms['residue_number'].max()
+    return pieces
+
+def _ca_coords(atoms, residue_numbers):
+    from numpy import isin
+    ca = (atoms['atom_name'] == 'CA') & isin(atoms['residue_number'], residue_numbers)
+    order = atoms['residue_number'][ca].argsort()
+    return atoms['xyz'][ca][order]
+
+def superposition(xyz_from, xyz_to):
+    '''Least squares rotation and shift taking xyz_from points onto xyz_to points.'''
+    from numpy import float64, linalg, diag
+    p, q = xyz_from.astype(float64), xyz_to.astype(float64)
+    pc, qc = p.mean(axis = 0), q.mean(axis = 0)
+    u, s, vt = linalg.svd((p - pc).T @ (q - qc))
+    d = diag((1, 1, 1 if linalg.det(vt.T @ u.T) > 0 else -1))
+    rot = vt.T @ d @ u.T
+    shift = qc - rot @ pc
+    return rot.astype(xyz_from.dtype), shift.astype(xyz_from.dtype)
+
+def concatenate_atoms(pieces):
+    from numpy import concatenate
+    return {name:concatenate([piece[name] for piece in pieces]) for name in pieces[0].keys()}
+
+class StitchedPAE:
+    '''
+    Full length predicted aligned error matrix made of overlapping square blocks
+    on the diagonal, one per segment.  Residue pairs in more than one block get
+    the average block value and pairs in no block get the maximum PAE value.
+    The dense N by N matrix is never made, only requested regions.
+    '''
+    def __init__(self, matrices, starts, max_pae = 31.75):
+        self.blocks = list(zip(starts, matrices))	# (first residue index, PAE matrix)
+        self.size = max(start + len(matrix) for start, matrix in self.blocks)
+        self.max_pae = max_pae
+
+    def region(self, r0, r1, c0, c1):
+        '''PAE for residue indices r0 <= i < r1, c0 <= j < c1, 0-based.'''
+        from numpy import zeros, float32, int32
+        sum = zeros((r1-r0, c1-c0), float32)
+        count = zeros((r1-r0, c1-c0), int32)
+        for start, matrix in self.blocks:
+            end = start + len(matrix)
+            br0, br1, bc0, bc1 = max(r0,start), min(r1,end), max(c0,start), min(c1,end)
+            if br0 < br1 and bc0 < bc1:
+                sum[br0-r0:br1-r0, bc0-c0:bc1-c0] += matrix[br0-start:br1-start, bc0-start:bc1-start]
+                count[br0-r0:br1-r0, bc0-c0:bc1-c0] += 1
+        pae = sum
+        covered = (count > 0)
+        pae[covered] /= count[covered]
+        pae[~covered] = self.max_pae
+        return pae
+
+    def mean(self, r0, r1, c0, c1, rows_per_pass = 256):
+        '''Mean PAE of a region computed a few rows at a time.'''
+        total = 0.0
+        for r in range(r0, r1, rows_per_pass):
+            total += self.region(r, min(r+rows_per_pass, r1), c0, c1).sum(dtype = 'float64')
+        return total / ((r1-r0)*(c1-c0))
+
+    def binned(self, bins = 1000, rows_per_pass = 256):
+        '''Average PAE over bins by bins blocks of residues for plotting.'''
+        from numpy import linspace, unique, add, empty, diff, float32
+        edges = unique(linspace(0, self.size, min(bins, self.size)+1).astype(int))
+        starts, sizes = edges[:-1], diff(edges)
+        image = empty((len(starts), len(starts)), float32)
+        bin_rows = max(1, rows_per_pass // int(sizes.max()))
+        for b in range(0, len(starts), bin_rows):
+            be = min(b + bin_rows, len(starts))
+            r0, r1 = edges[b], edges[be]
+            rows = add.reduceat(self.region(r0, r1, 0, self.size), starts, axis = 1)
+            rows = add.reduceat(rows, starts[b:be] - r0, axis = 0)
+            image[b:be] = rows / (sizes[b:be,None] * sizes[None,:])
+        return image
+
+def pae_image(pae, size = 500):
+    '''Color a PAE matrix with the ChimeraX pae palette and make a PIL image.'''
+    from numpy import array, interp, stack, uint8
+    values = (0, 5, 10, 15, 20, 25, 30)
+    colors = array(((0,0,255), (100,149,237), (255,255,0), (255,165,0),
+                    (128,128,128), (211,211,211), (255,255,255)))
+    rgb = stack([interp(pae, values, colors[:,c]) for c in range(3)], axis = -1).astype(uint8)
+    from PIL import Image
+    image = Image.fromarray(rgb)
+    return image.resize((size, size), Image.NEAREST)
+
+def show_stitched_pae(session, structures, bins = 1000, rows = None, columns = None):
+    '''Show the stitched PAE plot in the log, or the mean PAE of a region.'''
+    from chimerax.core.errors import UserError
+    for s in structures:
+        pae = getattr(s, 'bigalpha_pae', None)
+        if pae is None:
+            raise UserError('Structure %s was not opened with "bigalpha ... pae true"' % s.name)
+        if rows is None and columns is None:
+            msg = 'PAE %s, %d residues' % (s.name, pae.size)
+            session.logger.info(msg, image = pae_image(pae.binned(bins)))
+        else:
+            r0, r1 = _residue_range(rows, pae.size)
+            c0, c1 = _residue_range(columns, pae.size)
+            mean = pae.mean(r0, r1, c0, c1)
+            session.logger.info('PAE %s residues %d-%d to %d-%d mean %.2f'
+                                % (s.name, r0+1, r1, c0+1, c1, mean))
+
+def _residue_range(rrange, size):
+    # Residue range like "100-250" to 0-based start and end.
+    if rrange is None:
+        return 0, size
+    from chimerax.core.errors import UserError
+    try:
+        first, last = [int(r) for r in rrange.split('-')]
+    except ValueError:
+        raise UserError('Residue range must be two numbers like 100-250, got "%s"' % rrange)
+    return max(first-1, 0), min(last, size)
+
+def structure_from_atoms(session, atoms, name):
+    '''
+    Make a ChimeraX structure directly from atom arrays with residue numbers
+    and chain ids as given.  Bonds are added from residue templates.
+    '''
+    from chimerax.atomic import AtomicStructure, Element, Atoms
+    s = AtomicStructure(session, name = name)
+    elements = {e:Element.get_element(e) for e in set(atoms['element'].tolist())}
+    new_atoms = []
+    residue = rkey = None
+    for aname, ename, rname, cid, rnum in zip(atoms['atom_name'].tolist(), atoms['element'].tolist(),
+                                              atoms['residue_name'].tolist(), atoms['chain_id'].tolist(),
+                                              atoms['residue_number'].tolist()):
+        if (cid, rnum) != rkey:
+            residue = s.new_residue(rname, cid, rnum)
+            rkey = (cid, rnum)
+        a = s.new_atom(aname, elements[ename])
+        residue.add_atom(a)
+        new_atoms.append(a)
+    alist = Atoms(new_atoms)
+    alist.coords = atoms['xyz']
+    alist.bfactors = atoms['bfactor']
+    from numpy import arange, int32
+    alist.serial_numbers = arange(1, len(alist)+1, dtype = int32)
+    s.connect_structure()
+    return s
 
 def register_command(session):
-    from chimerax.core.commands import CmdDesc, register, StringArg, OpenFolderNameArg, BoolArg
+    from chimerax.core.commands import CmdDesc, register, StringArg, OpenFileNameArg, BoolArg, IntArg
     desc = CmdDesc(required=[('uniprot_id', StringArg)],
-                   keyword=[('directory', OpenFolderNameArg),
-                            ('combine', BoolArg)],
+                   keyword=[('directory', OpenFileNameArg),
+                            ('combine', BoolArg),
+                            ('processes', IntArg),
+                            ('pae', BoolArg)],
                    synopsis='Open multifile AlphaFold model')
     register('bigalpha', desc, open_multifile_alphafold_model, logger=session.logger)
 
+    from chimerax.atomic import StructuresArg
+    desc = CmdDesc(required=[('structures', StructuresArg)],
+                   keyword=[('bins', IntArg),
+                            ('rows', StringArg),
+                            ('columns', StringArg)],
+                   synopsis='Show PAE plot for multifile AlphaFold model')
+    register('bigalpha pae', desc, show_stitched_pae, logger=session.logger)
+
 register_command(session)
 
     
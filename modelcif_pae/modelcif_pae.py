@@ -2,82 +2,408 @@
 
 def modelcif_pae(session, structure, json_output_path = None, metric_id = None, default_score = 100):
 
-    matrix = read_pairwise_scores(structure, metric_id = metric_id, default_score = default_score)
+    matrix = metric_score_matrix(structure, metric_id = metric_id, default_score = default_score)
 
-    if json_output_path is None:
+    if json_output_path is not None:
+        write_json_pae_file(json_output_path, matrix)
+
+    # Open PAE plot
+    show_pae_plot(session, structure, matrix, json_output_path)
+
+def show_pae_plot(session, structure, matrix, json_output_path = None, max_plot_size = 5000):
+    '''
+    Show the matrix with the AlphaFold PAE plot directly instead of writing
+    a JSON file and reading it back with the alphafold pae command.  The PAE plot
+    needs a dense matrix so for more than max_plot_size residues an image of the
+    binned scores is shown in the log instead.
+    '''
+    if isinstance(matrix, ChainBlockMatrix):
+        if matrix.shape[0] > max_plot_size:
+            msg = f'Pairwise scores {structure.name}, {matrix.shape[0]} residues, {len(matrix.blocks)} chain pairs'
+            session.logger.info(msg, image = score_image(matrix.binned(1000)))
+            return
+        matrix = matrix.dense()
+    show_matrix_plot(session, structure, matrix, json_output_path)
+
+def show_matrix_plot(session, structure, matrix, json_output_path = None):
+    '''
+    Show the PAE plot for a square matrix with size equal to the number of residues.
+    If this ChimeraX cannot read the pickle file the plot is opened from a JSON file
+    with the alphafold pae command.
+    '''
+    structure_pae = alphafold_pae(structure, matrix)
+    if structure_pae is None:
+        # Older ChimeraX, open the plot from a JSON file.
         import tempfile
-        temp = tempfile.NamedTemporaryFile(prefix = 'modelcif_pae_', suffix = '.json')
-        json_output_path = temp.name
+        with tempfile.TemporaryDirectory(prefix = 'pae_plot_') as directory:
+            if json_output_path is None:
+                from os.path import join
+                json_output_path = join(directory, 'pae.json')
+                write_json_pae_file(json_output_path, matrix)
+            from chimerax.core.commands import run, quote_if_necessary
+            open_cmd = f'alphafold pae #{structure.id_string} file {quote_if_necessary(json_output_path)}'
+            run(session, open_cmd)
+        return
 
-    write_json_pae_file(json_output_path, matrix)
+    from chimerax.alphafold.pae import AlphaFoldPAEPlot
+    AlphaFoldPAEPlot(session, structure.name, structure_pae)
+    structure.alphafold_pae = structure_pae
 
-    # Open PAE plot
-    from chimerax.core.commands import run, quote_if_necessary
-    open_cmd = f'alphafold pae #{structure.id_string} file {quote_if_necessary(json_output_path)}'
-    run(session, open_cmd)
+def alphafold_pae(structure, matrix):
+    '''Make a ChimeraX AlphaFoldPAE for a matrix, or None if not supported by this ChimeraX.'''
+    try:
+        from chimerax.alphafold.pae import AlphaFoldPAE
+    except ImportError:
+        return None
+    import tempfile, pickle
+    from os.path import join
+    with tempfile.TemporaryDirectory(prefix = 'pae_plot_') as directory:
+        path = join(directory, 'pae.pkl')
+        with open(path, 'wb') as file:
+            pickle.dump({'predicted_aligned_error': matrix}, file)
+        try:
+            return AlphaFoldPAE(path, structure)
+        except Exception:
+            return None
+
+def write_json_pae_file(json_output_path, matrix, rows_per_write = 100):
+    # Write matrix in JSON AlphaFold PAE format
+    # {"pae": [[17.14, 18.75, 17.91, ...], [5.32, 8.23, ...], ... ]}
+    # a few rows at a time so the text for the whole matrix is never in memory.
+    n = matrix.shape[0]
+    row_format = '[ ' + ', '.join(['%.2f'] * n) + ' ]'
+    with open(json_output_path, 'w') as file:
+        file.write('{"pae": [')
+        for i in range(0, n, rows_per_write):
+            rows = matrix[i:i+rows_per_write].tolist()
+            if i > 0:
+                file.write(', ')
+            file.write(', '.join(row_format % tuple(row) for row in rows))
+        file.write(']}')
 
 def read_pairwise_scores(structure, metric_id = None, default_score = 100):
+    '''Return a dense numpy matrix of the scores for one metric id.'''
+    return metric_score_matrix(structure, metric_id, default_score).dense()
+
+def metric_score_matrix(structure, metric_id = None, default_score = 100):
+    '''Return the ChainBlockMatrix of scores for one metric id, default the first metric.'''
+    matrices = pairwise_score_matrices(structure, default_score)
+
+    # Use only the scores with the given metric id.
+    if metric_id is None:
+        metric_id = next(iter(matrices))
+    if metric_id not in matrices:
+        from chimerax.core.errors import UserError
+        raise UserError(f'Structure file {structure.filename} has no scores for metric id "{metric_id}"')
+
+    return matrices[metric_id]
+
+def pairwise_score_matrices(structure, default_score = 100):
+    '''
+    Return dictionary mapping metric id to score matrix for every metric in
+    the structure file, in the order the metrics appear in the file.
+    The matrices are cached so switching metrics does not read the file again.
+    '''
     if not hasattr(structure, 'filename'):
         from chimerax.core.errors import UserError
         raise UserError(f'Structure {structure} has no associated file')
 
-    values = read_ma_qa_metric_local_pairwise_table(structure.filename)
-    if values is None:
+    from os.path import getmtime
+    key = (structure.filename, getmtime(structure.filename), structure.num_residues, default_score)
+    matrices = _score_cache.get(key)
+    if matrices is None:
+        matrices = read_pairwise_score_matrices(structure, default_score)
+        _score_cache.add(key, matrices)
+    return matrices
+
+def read_pairwise_score_matrices(structure, default_score = 100):
+    table = read_ma_qa_metric_local_pairwise_table(structure.filename)
+    if table is None or len(table['metric_id']) == 0:
         from chimerax.core.errors import UserError
         raise UserError(f'Structure file {structure.filename} contains no pairwise residue scores (i.e. no table "ma_qa_metric_local_pairwise")')
-    
-    # Use only the scores with the given metric id.
-    if metric_id is None and len(values) > 0:
-        metric_id = values[0][5]
-    values = [v for v in values if v[5] == metric_id]
-    if len(values) == 0:
-        from chimerax.core.errors import UserError
-        raise UserError(f'Structure file {structure.filename} has no scores for metric id "{metric_id}"')
-    
-    matrix_index = {(r.chain_id,r.number):ri for ri,r in enumerate(structure.residues)}
-
-    nr = structure.num_residues
-    from numpy import empty, float32
-    matrix = empty((nr,nr), float32)
-    matrix[:] = default_score
-    
-    for model_id, chain_id_1, res_num_1, chain_id_2, res_num_2, metric_id, metric_value in values:
-        res_num_1, res_num_2, metric_value = int(res_num_1), int(res_num_2), float(metric_value)
-        r1 = matrix_index[(chain_id_1, res_num_1)]
-        r2 = matrix_index[(chain_id_2, res_num_2)]
-        matrix[r1,r2] = metric_value
-
-    return matrix
+
+    r1 = residue_indices(structure, table['label_asym_id_1'], table['label_seq_id_1'])
+    r2 = residue_indices(structure, table['label_asym_id_2'], table['label_seq_id_2'])
+    values = table['metric_value']
+
+    # Group rows by metric id.
+    from numpy import unique
+    metric_ids, first_row, metric = unique(table['metric_id'], return_index = True, return_inverse = True)
+    order = metric.argsort(kind = 'stable')
+    ends = metric[order].searchsorted(range(1, len(metric_ids)+1))
+
+    chain_starts = chain_segment_starts(structure.residues.chain_ids)
+    matrices = {}
+    for m in first_row.argsort():
+        rows = order[(ends[m-1] if m > 0 else 0):ends[m]]
+        matrix = ChainBlockMatrix(structure.num_residues, chain_starts, default_score)
+        matrix.set_values(r1[rows], r2[rows], values[rows])
+        matrices[str(metric_ids[m])] = matrix
+    return matrices
+
+def chain_segment_starts(chain_ids):
+    '''Index of first residue of each run of residues with the same chain id.'''
+    from numpy import concatenate, array
+    change = (chain_ids[1:] != chain_ids[:-1]).nonzero()[0] + 1
+    return concatenate((array([0]), change)) if len(chain_ids) > 0 else array([0])
+
+class ChainBlockMatrix:
+    '''
+    Residue pair score matrix that stores only the chain by chain blocks that have
+    scores.  Other blocks have the default score.  A 20,000 residue assembly would
+    need 1.6 Gbytes as a dense matrix, mostly default values when scores are only
+    given between a few chains.  Rectangles of the matrix are returned as dense
+    arrays, matrix[r0:r1,c0:c1], matrix[i] for a row or matrix[:,j] for a column.
+    '''
+    def __init__(self, size, chain_starts, default_score = 100):
+        from numpy import concatenate, array, float32
+        self.shape = (size, size)
+        self.dtype = float32
+        self.default_score = default_score
+        self.chain_starts = chain_starts
+        self.chain_ends = concatenate((chain_starts[1:], array([size])))
+        self.blocks = {}	# (chain index 1, chain index 2) -> dense block
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self.blocks.values())
+
+    def chain_index(self, residue_indices):
+        return self.chain_starts.searchsorted(residue_indices, side = 'right') - 1
+
+    def set_values(self, r1, r2, values):
+        '''Set matrix values at residue index pairs making blocks as needed.'''
+        c1, c2 = self.chain_index(r1), self.chain_index(r2)
+        nc = len(self.chain_starts)
+        from numpy import unique, full
+        pairs, pair = unique(c1 * nc + c2, return_inverse = True)
+        order = pair.argsort(kind = 'stable')
+        ends = pair[order].searchsorted(range(1, len(pairs)+1))
+        starts, cends = self.chain_starts, self.chain_ends
+        for p, (b, e) in enumerate(zip((0,) + tuple(ends[:-1]), ends)):
+            ci, cj = divmod(int(pairs[p]), nc)
+            block = self.blocks.get((ci,cj))
+            if block is None:
+                block = full((cends[ci]-starts[ci], cends[cj]-starts[cj]), self.default_score, self.dtype)
+                self.blocks[(ci,cj)] = block
+            rows = order[b:e]
+            block[r1[rows] - starts[ci], r2[rows] - starts[cj]] = values[rows]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index, slice(None))
+        rows, cols = [(*i.indices(n)[:2], False) if isinstance(i, slice) else (int(i) % n, int(i) % n + 1, True)
+                      for i, n in zip(index, self.shape)]
+        m = self.region(rows[0], rows[1], cols[0], cols[1])
+        if cols[2]:
+            m = m[:,0]
+        if rows[2]:
+            m = m[0]
+        return m
+
+    def region(self, r0, r1, c0, c1):
+        '''Dense scores for residue indices r0 <= i < r1, c0 <= j < c1.'''
+        from numpy import full
+        m = full((max(0,r1-r0), max(0,c1-c0)), self.default_score, self.dtype)
+        starts, ends = self.chain_starts, self.chain_ends
+        for (ci, cj), block in self.blocks.items():
+            br0, br1 = max(r0, starts[ci]), min(r1, ends[ci])
+            bc0, bc1 = max(c0, starts[cj]), min(c1, ends[cj])
+            if br0 < br1 and bc0 < bc1:
+                m[br0-r0:br1-r0, bc0-c0:bc1-c0] = block[br0-starts[ci]:br1-starts[ci],
+                                                        bc0-starts[cj]:bc1-starts[cj]]
+        return m
+
+    def dense(self):
+        return self.region(0, self.shape[0], 0, self.shape[1])
+
+    def binned(self, bins = 1000, rows_per_pass = 256):
+        '''Average scores over bins by bins blocks of residues.'''
+        n = self.shape[0]
+        from numpy import linspace, unique, add, empty, diff, float32
+        edges = unique(linspace(0, n, min(bins, n)+1).astype(int))
+        starts, sizes = edges[:-1], diff(edges)
+        image = empty((len(starts), len(starts)), float32)
+        bin_rows = max(1, rows_per_pass // int(sizes.max()))
+        for b in range(0, len(starts), bin_rows):
+            be = min(b + bin_rows, len(starts))
+            r0, r1 = edges[b], edges[be]
+            rows = add.reduceat(self.region(r0, r1, 0, n), starts, axis = 1)
+            rows = add.reduceat(rows, starts[b:be] - r0, axis = 0)
+            image[b:be] = rows / (sizes[b:be,None] * sizes[None,:])
+        return image
+
+def score_image(scores, size = 500):
+    '''Color scores with the ChimeraX pae palette as a PIL image.'''
+    from numpy import array, interp, stack, uint8
+    values = (0, 5, 10, 15, 20, 25, 30)
+    colors = array(((0,0,255), (100,149,237), (255,255,0), (255,165,0),
+                    (128,128,128), (211,211,211), (255,255,255)))
+    rgb = stack([interp(scores, values, colors[:,c]) for c in range(3)], axis = -1).astype(uint8)
+    from PIL import Image
+    return Image.fromarray(rgb).resize((size, size), Image.NEAREST)
+
+class ScoreMatrixCache:
+    '''
+    Score matrices for recently plotted structure files.  The least recently used
+    files are dropped when the matrices take more than max_bytes of memory.
+    '''
+    def __init__(self, max_bytes = 2**31):
+        self.max_bytes = max_bytes
+        from collections import OrderedDict
+        self._matrices = OrderedDict()	# Key -> {metric_id: matrix}
+
+    def get(self, key):
+        matrices = self._matrices.get(key)
+        if matrices is not None:
+            self._matrices.move_to_end(key)
+        return matrices
+
+    def add(self, key, matrices):
+        self._matrices[key] = matrices
+        self._matrices.move_to_end(key)
+        while len(self._matrices) > 1 and self.size() > self.max_bytes:
+            self._matrices.popitem(last = False)
+
+    def size(self):
+        return sum(m.nbytes for matrices in self._matrices.values() for m in matrices.values())
+
+    def clear(self):
+        self._matrices.clear()
+
+_score_cache = ScoreMatrixCache()
+
+def save_pairwise_scores(session, structure, path, default_score = 100):
+    '''
+    Save all score matrices in a numpy .npz file.  Each chain pair block with scores
+    is saved as an array named metric_<id>_<chain index 1>_<chain index 2>, with
+    the first residue index of each chain in array chain_starts and the
+    matrix size in array size.
+    '''
+    matrices = pairwise_score_matrices(structure, default_score)
+    arrays = {}
+    for metric_id, matrix in matrices.items():
+        for (ci,cj), block in matrix.blocks.items():
+            arrays[f'metric_{metric_id}_{ci}_{cj}'] = block
+    from numpy import savez, array
+    arrays['chain_starts'] = matrix.chain_starts
+    arrays['size'] = array(matrix.shape[0])
+    arrays['default_score'] = array(default_score)
+    with open(path, 'wb') as file:
+        savez(file, **arrays)
+    session.logger.info(f'Saved {len(matrices)} score matrices for metric ids {", ".join(matrices.keys())} to {path}')
+
+def residue_indices(structure, chain_ids, residue_numbers):
+    '''
+    Index in structure.residues for each chain id and residue number using a
+    lookup array per chain instead of a dictionary lookup per score.
+    '''
+    residues = structure.residues
+    rchain_ids, rnums = residues.chain_ids, residues.numbers
+    from numpy import empty, full, unique, int64
+    indices = empty((len(chain_ids),), int64)
+    for chain_id in unique(chain_ids):
+        ri = (rchain_ids == chain_id).nonzero()[0]
+        rows = (chain_ids == chain_id).nonzero()[0]
+        nums = residue_numbers[rows]
+        if len(ri) > 0:
+            rmin = min(rnums[ri].min(), nums.min())
+            lookup = full((max(rnums[ri].max(), nums.max()) - rmin + 1,), -1, int64)
+            lookup[rnums[ri] - rmin] = ri
+            indices[rows] = lookup[nums - rmin]
+        if len(ri) == 0 or (indices[rows] < 0).any():
+            bad = nums[0] if len(ri) == 0 else nums[indices[rows] < 0][0]
+            from chimerax.core.errors import UserError
+            raise UserError(f'Structure {structure} has no residue {chain_id}:{bad} used in pairwise scores')
+    return indices
+
+pairwise_fields = (('label_asym_id_1', 'U4'), ('label_seq_id_1', 'i4'),
+                   ('label_asym_id_2', 'U4'), ('label_seq_id_2', 'i4'),
+                   ('metric_id', 'U16'), ('metric_value', 'f4'))
 
 def read_ma_qa_metric_local_pairwise_table(path):
+    '''
+    Return a dictionary of numpy arrays for the pairwise score columns, or None
+    if there is no ma_qa_metric_local_pairwise table.  A complex with 3000 residues
+    has 9 million scores so the table rows are parsed with numpy loadtxt() instead
+    of making Python strings for every value.  Chain and metric ids are read as
+    short fixed width strings, and if any id fills its width the table is read
+    again with wider strings so long ids are never truncated.
+    '''
+    dtypes = dict(pairwise_fields)
+    while True:
+        table = _read_pairwise_loop(path, dtypes)
+        if table is None or isinstance(table, dict):
+            return table
+        from numpy import char
+        full = [name for name, dtype in dtypes.items()
+                if dtype.startswith('U') and len(table) > 0 and
+                char.str_len(table[name]).max() >= int(dtype[1:])]
+        if not full:
+            return {name:table[name] for name in dtypes.keys()}
+        for name in full:
+            dtypes[name] = 'U%d' % (4*int(dtypes[name][1:]))
+
+def _read_pairwise_loop(path, dtypes):
+    prefix = '_ma_qa_metric_local_pairwise.'
+    with open_text(path) as file:
+        columns = []
+        loop = False
+        previous = ''
+        for line in file:
+            if line.startswith(prefix):
+                if not columns:
+                    loop = previous.startswith('loop_')
+                columns.append(line[len(prefix):].strip())
+            elif columns:
+                break
+            elif line.strip():
+                previous = line
+        else:
+            line = ''
+        if len(columns) == 0:
+            return None
+        if not loop:
+            return _read_pairwise_table_rows(path)	# Single row table, one field per line.
+        field_names = list(dtypes.keys())
+        missing = [name for name in field_names if name not in columns]
+        from chimerax.core.errors import UserError
+        if missing:
+            raise UserError(f'Table ma_qa_metric_local_pairwise in {path} is missing columns {", ".join(missing)}')
+        from numpy import loadtxt
+        try:
+            table = loadtxt(_loop_data_lines(line, file), dtype = list(dtypes.items()),
+                            usecols = [columns.index(name) for name in field_names],
+                            comments = None, ndmin = 1)
+        except ValueError as e:
+            raise UserError(f'Could not read table ma_qa_metric_local_pairwise in {path}: {e}')
+    return table
+
+def _loop_data_lines(line, file):
+    # Lines of a CIF loop up to the next category, loop or comment line.
+    while line and not line.startswith(('#', '_', 'loop_', 'data_')):
+        if line.strip():
+            yield line
+        line = next(file, '')
+
+def _read_pairwise_table_rows(path):
     from chimerax.mmcif import get_cif_tables
-    table_names = ['ma_qa_metric_local_pairwise']
+    table = get_cif_tables(path, ['ma_qa_metric_local_pairwise'])[0]
+    rows = table.fields([name for name, dtype in pairwise_fields])
+    from numpy import array
     try:
-        tables = get_cif_tables(path, table_names)
-    except TypeError:
-        # Bug in get_cif_tables() results in TypeError if table not present.  Ticket #16054
-        return None
-    if len(tables) == 0:
-        return None
-    ma_qa_metric_local_pairwise = tables[0]
-
-    field_names = ['model_id',
-                   'label_asym_id_1', 'label_seq_id_1',
-                   'label_asym_id_2', 'label_seq_id_2',
-                   'metric_id', 'metric_value']
-    values = ma_qa_metric_local_pairwise.fields(field_names)
-    return values
+        # String columns are sized to fit the longest id.
+        return {name:array([row[c] for row in rows]).astype(str if dtype.startswith('U') else dtype)
+                for c, (name, dtype) in enumerate(pairwise_fields)}
+    except ValueError as e:
+        from chimerax.core.errors import UserError
+        raise UserError(f'Could not read table ma_qa_metric_local_pairwise in {path}: {e}')
 
-def write_json_pae_file(json_output_path, matrix):
-    # Write matrix in JSON AlphaFold PAE format
-    # {"pae": [[17.14, 18.75, 17.91, ...], [5.32, 8.23, ...], ... ]}
-    n = matrix.shape[0]
-    dists = ', '.join(('[ ' + ', '.join('%.2f' % matrix[i,j] for j in range(n)) + ' ]')
-                      for i in range(n))
-    with open(json_output_path, 'w') as file:
-        file.write('{"pae": [')
-        file.write(dists)
-        file.write(']}')
+def open_text(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
 
 def register_command(logger):
     from chimerax.core.commands import CmdDesc, register, StringArg, FloatArg, SaveFileNameArg
@@ -91,4 +417,12 @@ def register_command(logger):
     )
     register('modelcif pae', desc, modelcif_pae, logger=logger)
 
+    desc = CmdDesc(
+        required = [('structure', StructureArg),
+                    ('path', SaveFileNameArg)],
+        keyword = [('default_score', FloatArg)],
+        synopsis = 'Save all ModelCIF pairwise residue score matrices to a numpy file'
+    )
+    register('modelcif save', desc, save_pairwise_scores, logger=logger)
+
 register_command(session.logger)
@@ -0,0 +1,235 @@
+# Mean, minimum and count of AlphaFold predicted aligned error (PAE) values in
+# rectangles of the PAE matrix using a summed-area table (integral image).
+#
+# The table is made once for each PAE matrix and then the sum of any rectangle is
+# 4 table lookups, so mean PAE for a dragged box on the plot of a 10,000 residue
+# prediction or chain by chain mean PAE for thousands of predictions is fast.
+#
+#  open pae_mean.py
+#  alphafold fetch Q8WZ42
+#  pae mean #1 rows /A:1-300 columns /A:500-900
+#  pae mean #1 chains true
+#  pae mean #1 domains 1-120,121-300,301-450 cutoff 5
+#
+# Domains are residue ranges given by first and last residue positions in the
+# PAE matrix, starting at 1.  With a cutoff the chain or domain tables are followed
+# by a table of the number of residue pairs with PAE at or below the cutoff.
+#
+
+class PAESummedArea:
+    '''
+    Summed-area tables for a PAE matrix giving the sum, mean, and number of values
+    at or below a cutoff for any rectangle in constant time.  Rectangle minima
+    use a table of block minima so they take time proportional to the number of
+    blocks and the block size times the rectangle perimeter, not constant time.
+    '''
+    def __init__(self, pae_matrix, block_size = 32):
+        self.pae_matrix = pae_matrix
+        self.shape = pae_matrix.shape
+        self._sum = summed_area_table(pae_matrix)
+        self._counts = {}		# Cutoff -> summed area table of values <= cutoff
+        self._block_size = block_size
+        self._block_min = None
+
+    def sum(self, r0, r1, c0, c1):
+        '''Sum of values in rows r0 <= i < r1 and columns c0 <= j < c1.'''
+        return rectangle_sums(self._sum, r0, r1, c0, c1)
+
+    def mean(self, r0, r1, c0, c1):
+        return self.sum(r0, r1, c0, c1) / ((r1-r0)*(c1-c0))
+
+    def count(self, r0, r1, c0, c1, cutoff = None):
+        '''Number of values in a rectangle, or number at or below cutoff.'''
+        if cutoff is None:
+            return (r1-r0)*(c1-c0)
+        return int(rectangle_sums(self._count_table(cutoff), r0, r1, c0, c1))
+
+    def _count_table(self, cutoff):
+        table = self._counts.get(cutoff)
+        if table is None:
+            # Integer counts, 32-bit unless the matrix has more than 2^31 values.
+            n = self.pae_matrix.size
+            from numpy import int32, int64
+            dtype = int32 if n < 2**31 else int64
+            self._counts[cutoff] = table = summed_area_table(self.pae_matrix <= cutoff, dtype)
+        return table
+
+    def min(self, r0, r1, c0, c1):
+        '''Minimum value in a rectangle using minima of blocks inside the rectangle.'''
+        b = self._block_size
+        bm = self._block_minima()
+        # Whole blocks inside the rectangle.
+        br0, br1, bc0, bc1 = -(-r0 // b), r1 // b, -(-c0 // b), c1 // b
+        if br0 >= br1 or bc0 >= bc1:
+            return self.pae_matrix[r0:r1,c0:c1].min()
+        m = self.pae_matrix
+        mins = [bm[br0:br1,bc0:bc1].min()]
+        # Strips along the edges not covered by whole blocks.
+        for strip in (m[r0:br0*b,c0:c1], m[br1*b:r1,c0:c1],
+                      m[br0*b:br1*b,c0:bc0*b], m[br0*b:br1*b,bc1*b:c1]):
+            if strip.size > 0:
+                mins.append(strip.min())
+        return min(mins)
+
+    def _block_minima(self):
+        if self._block_min is None:
+            b = self._block_size
+            m = self.pae_matrix
+            nr, nc = m.shape[0] // b, m.shape[1] // b
+            self._block_min = m[:nr*b,:nc*b].reshape((nr,b,nc,b)).min(axis = (1,3))
+        return self._block_min
+
+    def segment_means(self, row_ranges, column_ranges = None):
+        '''
+        Mean for every pair of segments, such as chains or domains, given as
+        (start, end) index ranges with end one past the last index.
+        '''
+        r0, r1, c0, c1 = self._segment_bounds(row_ranges, column_ranges)
+        return rectangle_sums(self._sum, r0, r1, c0, c1) / ((r1-r0)*(c1-c0))
+
+    def segment_counts(self, cutoff, row_ranges, column_ranges = None):
+        '''Number of values at or below cutoff for every pair of segments.'''
+        r0, r1, c0, c1 = self._segment_bounds(row_ranges, column_ranges)
+        return rectangle_sums(self._count_table(cutoff), r0, r1, c0, c1).astype(int)
+
+    def _segment_bounds(self, row_ranges, column_ranges):
+        if column_ranges is None:
+            column_ranges = row_ranges
+        from numpy import array
+        rr, cr = array(row_ranges), array(column_ranges)
+        return rr[:,0,None], rr[:,1,None], cr[None,:,0], cr[None,:,1]
+
+    def runs_mean(self, row_runs, column_runs):
+        '''Mean over rows and columns each given as a list of (start, end) runs.'''
+        from numpy import array
+        rr, cr = array(row_runs), array(column_runs)
+        sums = rectangle_sums(self._sum, rr[:,0,None], rr[:,1,None], cr[None,:,0], cr[None,:,1])
+        count = (rr[:,1]-rr[:,0]).sum() * (cr[:,1]-cr[:,0]).sum()
+        return sums.sum() / count
+
+def summed_area_table(matrix, dtype = None):
+    '''
+    Table S with S[i,j] the sum of matrix[:i,:j], one row and column larger than matrix.
+    Sums are float64 unless another numpy type is given.
+    '''
+    from numpy import zeros, float64
+    if dtype is None:
+        dtype = float64
+    nr, nc = matrix.shape
+    table = zeros((nr+1, nc+1), dtype)
+    matrix.cumsum(axis = 0, dtype = dtype, out = table[1:,1:])
+    table[1:,1:].cumsum(axis = 1, out = table[1:,1:])
+    return table
+
+def rectangle_sums(table, r0, r1, c0, c1):
+    return table[r1,c1] - table[r0,c1] - table[r1,c0] + table[r0,c0]
+
+def pae_summed_area(pae):
+    '''Summed-area tables for a ChimeraX AlphaFoldPAE, made once and kept with it.'''
+    matrix = pae.pae_matrix
+    sa = getattr(pae, '_summed_area', None)
+    if sa is None or sa.pae_matrix is not matrix:
+        pae._summed_area = sa = PAESummedArea(matrix)
+    return sa
+
+def add_summed_area_method():
+    '''
+    Give ChimeraX AlphaFoldPAE objects a summed_area() method so the PAE plot
+    dragged box code can average rectangles with pae.summed_area().mean(r0,r1,c0,c1).
+    '''
+    from chimerax.alphafold.pae import AlphaFoldPAE
+    AlphaFoldPAE.summed_area = pae_summed_area
+
+def index_runs(indices):
+    '''Runs of consecutive sorted indices as (start, end) pairs with end one past the last.'''
+    from numpy import diff, concatenate
+    if len(indices) == 0:
+        return []
+    breaks = (diff(indices) != 1).nonzero()[0] + 1
+    starts = concatenate(([0], breaks))
+    ends = concatenate((breaks, [len(indices)]))
+    return [(int(indices[s]), int(indices[e-1])+1) for s,e in zip(starts, ends)]
+
+def domain_range(domain, n):
+    '''Parse a residue range like 121-300 into (start, end) matrix indices.'''
+    from chimerax.core.errors import UserError
+    try:
+        first, last = [int(r) for r in domain.split('-')]
+    except ValueError:
+        raise UserError(f'Domains must be residue ranges like 1-120,121-300, got "{domain}"')
+    if first < 1 or last < first or last > n:
+        raise UserError(f'Domain {domain} is not within PAE matrix residues 1-{n}')
+    return (first-1, last)
+
+def pae_mean(session, structures, rows = None, columns = None, chains = False, domains = None,
+             cutoff = None, output = None):
+    '''Report mean PAE for residue ranges, or chain by chain or domain by domain tables.'''
+    from chimerax.core.errors import UserError
+    lines = []
+    for s in structures:
+        pae = getattr(s, 'alphafold_pae', None)
+        if pae is None:
+            raise UserError(f'Structure {s} has no PAE matrix, open one with alphafold pae')
+        sa = pae_summed_area(pae)
+        n = sa.shape[0]
+        if n != s.num_residues:
+            raise UserError(f'PAE matrix size {n} does not match {s.num_residues} residues of {s}')
+
+        if chains or domains:
+            if chains:
+                cids = s.residues.chain_ids
+                starts = [0] + ((cids[1:] != cids[:-1]).nonzero()[0] + 1).tolist()
+                ranges = list(zip(starts, starts[1:] + [n]))
+                names = [cids[i] for i in starts]
+            else:
+                names = domains.split(',')
+                ranges = [domain_range(d, n) for d in names]
+            means = sa.segment_means(ranges)
+            lines.append(f'# Mean PAE {s}, rows aligned to columns')
+            lines.append(','.join(['', *names]))
+            lines.extend(','.join([name] + ['%.3g' % m for m in row]) for name, row in zip(names, means))
+            if cutoff is not None:
+                counts = sa.segment_counts(cutoff, ranges)
+                lines.append(f'# Number of residue pairs with PAE <= {"%.3g" % cutoff} {s}, rows aligned to columns')
+                lines.append(','.join(['', *names]))
+                lines.extend(','.join([name] + ['%d' % c for c in row]) for name, row in zip(names, counts))
+        else:
+            res = s.residues
+            from numpy import arange, unique
+            ri = res.indices(rows) if rows is not None else arange(n)
+            ci = res.indices(columns) if columns is not None else arange(n)
+            rruns, cruns = index_runs(unique(ri[ri >= 0])), index_runs(unique(ci[ci >= 0]))
+            if len(rruns) == 0 or len(cruns) == 0:
+                raise UserError(f'No residues of {s} specified')
+            mean = sa.runs_mean(rruns, cruns)
+            msg = f'Mean PAE {"%.3g" % mean} for {s}'
+            if len(rruns) == 1 and len(cruns) == 1:
+                (r0,r1), (c0,c1) = rruns[0], cruns[0]
+                msg += f' min {"%.3g" % sa.min(r0,r1,c0,c1)}'
+                if cutoff is not None:
+                    msg += f', {sa.count(r0,r1,c0,c1,cutoff)} of {sa.count(r0,r1,c0,c1)} pairs with pae <= {"%.3g" % cutoff}'
+            lines.append(msg)
+
+    text = '\n'.join(lines)
+    session.logger.info(text)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text + '\n')
+
+def register_command(logger):
+    from chimerax.core.commands import CmdDesc, register, BoolArg, StringArg, FloatArg, SaveFileNameArg
+    from chimerax.atomic import StructuresArg, ResiduesArg
+    desc = CmdDesc(
+        required = [('structures', StructuresArg)],
+        keyword = [('rows', ResiduesArg),
+                   ('columns', ResiduesArg),
+                   ('chains', BoolArg),
+                   ('domains', StringArg),
+                   ('cutoff', FloatArg),
+                   ('output', SaveFileNameArg)],
+        synopsis = 'Report mean AlphaFold PAE for residue ranges, chains or domains'
+    )
+    register('pae mean', desc, pae_mean, logger=logger)
+
+add_summed_area_method()
+register_command(session.logger)
@@ -1,8 +1,17 @@
-# Compute all pairwise distances between residues and write to a JSON file in AlphaFold PAE
-# format so that the distance map can be displayed as a 2D plot with menu entry
-# Tools / Structure Prediction / AlphaFold Error Plot.
+# Compute all pairwise distances between residues and show them with the AlphaFold PAE
+# plot (menu entry Tools / Structure Prediction / AlphaFold Error Plot).  Optionally
+# write the distances to a JSON file in AlphaFold PAE format.
+#
+# With option "ensemble true" the distances for every coordinate set of a
+# trajectory or NMR ensemble are computed and the mean, standard deviation,
+# minimum, maximum or fraction of coordinate sets with distance below a
+# cutoff is plotted, for example
+#
+#    rrdist #1 ensemble true statistic sd
+#    rrdist #1 ensemble true statistic contact cutoff 8
 
-def rr_distance_map(session, structure, json_output_path):
+def rr_distance_map(session, structure, json_output_path = None, ensemble = False,
+                    statistic = 'mean', cutoff = 8.0, threads = None):
     residues = structure.residues
 
     # Choose atom for each residue to measure distances
@@ -18,34 +27,182 @@ def rr_distance_map(session, structure, json_output_path):
 
     # Compute distance matrix
     from chimerax.atomic import Atoms
-    xyz = Atoms(atoms).scene_coords
-    n = len(xyz)
-    from numpy import empty, float32, sqrt
-    dist = empty((n,n), float32)
-    for i in range(n):
-        row = xyz - xyz[i]
-        dist[i,:] = sqrt((row*row).sum(axis = 1))
+    atoms = Atoms(atoms)
+    if ensemble:
+        stats = DistanceStatistics(len(atoms), cutoff, threads)
+        for xyz in coordset_coords(structure, atoms):
+            stats.add(xyz)
+        stats.close()
+        structure.rrdist_statistics = stats
+        dist = stats.matrix(statistic)
+        session.logger.info(f'Residue distance {statistic} for {stats.count} coordinate sets of {structure}')
+    else:
+        dist = distance_matrix(atoms.scene_coords, threads)
 
+    if json_output_path is not None:
+        write_json_pae_file(json_output_path, dist)
+
+    # Open PAE plot
+    show_pae_plot(session, structure, dist, json_output_path)
+
+def coordset_coords(structure, atoms):
+    '''Yield atom coordinates for each coordinate set of a structure.'''
+    active_id = structure.active_coordset_id
+    try:
+        for cs_id in structure.coordset_ids:
+            structure.active_coordset_id = cs_id
+            yield atoms.coords
+    finally:
+        structure.active_coordset_id = active_id
+
+def distance_matrix(xyz, threads = None):
+    stats = DistanceStatistics(len(xyz), threads = threads)
+    d = stats.matrix_blocks(xyz)
+    stats.close()
+    return d
+
+class DistanceStatistics:
+    '''
+    Running mean, standard deviation (Welford), minimum, maximum and contact
+    frequency of residue pair distances over coordinate sets, without keeping
+    the distance matrix for each coordinate set.  Rows are computed in blocks
+    in a thread pool since numpy releases the Python global lock.
+    '''
+    def __init__(self, n, cutoff = 8.0, threads = None, block_size = 256):
+        self.n = n
+        self.cutoff = cutoff
+        self.count = 0
+        self._blocks = [(r, min(r+block_size, n)) for r in range(0, n, block_size)]
+        self._stats = None
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers = threads)
+
+    def add(self, xyz):
+        if self._stats is None:
+            from numpy import zeros, full, float64, float32, int32, inf
+            n = self.n
+            self._stats = {'mean': zeros((n,n), float64), 'm2': zeros((n,n), float64),
+                           'min': full((n,n), inf, float32), 'max': zeros((n,n), float32),
+                           'contact': zeros((n,n), int32)}
+        self.count += 1
+        x = xyz.astype('float64')
+        list(self._pool.map(lambda block: self._add_block(x, *block), self._blocks))
+
+    def _add_block(self, xyz, r0, r1):
+        d = distance_block(xyz, r0, r1)
+        s = self._stats
+        mean, m2 = s['mean'][r0:r1], s['m2'][r0:r1]
+        delta = d - mean
+        mean += delta / self.count
+        m2 += delta * (d - mean)
+        from numpy import minimum, maximum
+        minimum(s['min'][r0:r1], d, out = s['min'][r0:r1])
+        maximum(s['max'][r0:r1], d, out = s['max'][r0:r1])
+        s['contact'][r0:r1] += (d <= self.cutoff)
+
+    def matrix_blocks(self, xyz):
+        '''Distance matrix for one coordinate set computed in row blocks.'''
+        from numpy import empty, float32
+        d = empty((self.n, self.n), float32)
+        x = xyz.astype('float64')
+        def fill(block):
+            r0, r1 = block
+            d[r0:r1] = distance_block(x, r0, r1)
+        list(self._pool.map(fill, self._blocks))
+        return d
+
+    def matrix(self, statistic = 'mean'):
+        '''Matrix of mean, sd, min, max or contact (fraction of coordinate sets within cutoff).'''
+        s = self._stats
+        from numpy import sqrt, float32
+        if statistic == 'mean':
+            return s['mean'].astype(float32)
+        elif statistic == 'sd':
+            return sqrt(s['m2'] / self.count).astype(float32)
+        elif statistic == 'contact':
+            return (s['contact'] / self.count).astype(float32)
+        return s[statistic]
+
+    def close(self):
+        self._pool.shutdown()
+
+def distance_block(xyz, r0, r1):
+    '''Distances from points r0 to r1 to all points, |a|^2 + |b|^2 - 2 a.b using matrix multiply.'''
+    from numpy import sqrt, maximum, arange, float32
+    a = xyz[r0:r1]
+    d2 = (a*a).sum(axis = 1)[:,None] + (xyz*xyz).sum(axis = 1)[None,:] - 2 * (a @ xyz.T)
+    maximum(d2, 0, out = d2)
+    d = sqrt(d2).astype(float32)
+    i = arange(r1-r0)
+    d[i, r0+i] = 0
+    return d
+
+def show_pae_plot(session, structure, matrix, json_output_path = None):
+    '''
+    Show the PAE plot for a square matrix with size equal to the number of residues.
+    If this ChimeraX cannot read the pickle file the plot is opened from a JSON file
+    with the alphafold pae command.
+    '''
+    structure_pae = alphafold_pae(structure, matrix)
+    if structure_pae is None:
+        # Older ChimeraX, open the plot from a JSON file.
+        import tempfile
+        with tempfile.TemporaryDirectory(prefix = 'pae_plot_') as directory:
+            if json_output_path is None:
+                from os.path import join
+                json_output_path = join(directory, 'pae.json')
+                write_json_pae_file(json_output_path, matrix)
+            from chimerax.core.commands import run, quote_if_necessary
+            open_cmd = f'alphafold pae #{structure.id_string} file {quote_if_necessary(json_output_path)}'
+            run(session, open_cmd)
+        return
+
+    from chimerax.alphafold.pae import AlphaFoldPAEPlot
+    AlphaFoldPAEPlot(session, structure.name, structure_pae)
+    structure.alphafold_pae = structure_pae
+
+def alphafold_pae(structure, matrix):
+    '''Make a ChimeraX AlphaFoldPAE for a matrix, or None if not supported by this ChimeraX.'''
+    try:
+        from chimerax.alphafold.pae import AlphaFoldPAE
+    except ImportError:
+        return None
+    import tempfile, pickle
+    from os.path import join
+    with tempfile.TemporaryDirectory(prefix = 'pae_plot_') as directory:
+        path = join(directory, 'pae.pkl')
+        with open(path, 'wb') as file:
+            pickle.dump({'predicted_aligned_error': matrix}, file)
+        try:
+            return AlphaFoldPAE(path, structure)
+        except Exception:
+            return None
+
+def write_json_pae_file(json_output_path, matrix, rows_per_write = 100):
     # Write matrix in JSON AlphaFold PAE format
     # {"pae": [[17.14, 18.75, 17.91, ...], [5.32, 8.23, ...], ... ]}
-    dists = ', '.join(('[ ' + ', '.join('%.2f' % dist[i,j] for j in range(n)) + ' ]')
-                      for i in range(n))
+    # a few rows at a time so the text for the whole matrix is never in memory.
+    n = matrix.shape[0]
+    row_format = '[ ' + ', '.join(['%.2f'] * n) + ' ]'
     with open(json_output_path, 'w') as file:
         file.write('{"pae": [')
-        file.write(dists)
+        for i in range(0, n, rows_per_write):
+            rows = matrix[i:i+rows_per_write].tolist()
+            if i > 0:
+                file.write(', ')
+            file.write(', '.join(row_format % tuple(row) for row in rows))
         file.write(']}')
 
-    # Open PAE plot
-    from chimerax.core.commands import run, quote_if_necessary
-    open_cmd = f'alphafold pae #{structure.id_string} file {quote_if_necessary(json_output_path)}'
-    run(session, open_cmd)
-
 def register_command(logger):
-    from chimerax.core.commands import CmdDesc, register, SaveFileNameArg
+    from chimerax.core.commands import CmdDesc, register, SaveFileNameArg, BoolArg, EnumOf, FloatArg, IntArg
     from chimerax.atomic import StructureArg
     desc = CmdDesc(
-        required = [('structure', StructureArg),
-                    ('json_output_path', SaveFileNameArg)],
+        required = [('structure', StructureArg)],
+        optional = [('json_output_path', SaveFileNameArg)],
+        keyword = [('ensemble', BoolArg),
+                   ('statistic', EnumOf(('mean', 'sd', 'min', 'max', 'contact'))),
+                   ('cutoff', FloatArg),
+                   ('threads', IntArg)],
         synopsis = 'Compute residue-residue distance map and show with AlphaFold PAE plot'
     )
     register('rrdist', desc, rr_distance_map, logger=logger)
@@ -6,7 +6,24 @@
 #
 #     spots #1.2 threshold 10 output spots.csv
 #
-def spots(session, map, threshold_sdev = None, output_csv = None, smoothing_steps = 0):
+# Segger needs the graphical user interface.  Without it (chimerax --nogui) the
+# watershed segmentation in spotseg.py is used, which must be in the same directory
+# as this file.  The method option chooses "segger" or "watershed".
+#
+# Every time point of a volume series is quantified in a pool of processes with
+#
+#     spots series #1 threshold 10 output spots.csv
+#
+# and the spots are linked between time points into tracks with
+#
+#     spots track spots.csv maps #1 maxDisplacement 5
+#
+import sys
+from os.path import dirname, abspath
+sys.path.insert(0, dirname(abspath(__file__)))
+
+def spots(session, map, threshold_sdev = None, output_csv = None, smoothing_steps = 0,
+          method = None):
     '''Segment light microscopy to quantify spots, report intensities.'''
 
     # Show map in surface style at desired threshold level at full resolution
@@ -21,8 +38,13 @@ def spots(session, map, threshold_sdev = None, output_csv = None, smoothing_step
     elif len(map.surfaces) == 0:
         map.update_drawings()	# Set initial threshold level
 
-    # Run Segger watershed segmentation
-    spots = segment_spots(map, smoothing_steps)
+    # Run Segger or spotseg watershed segmentation
+    if method is None:
+        method = 'segger' if session.ui.is_gui else 'watershed'
+    if method == 'segger':
+        spots = segment_spots(map, smoothing_steps)
+    else:
+        spots = watershed_spots(map, smoothing_steps)
 
     # Log comma-separated values file of spots.
     lines = ['# Spot number, total intensity, mean intensity, max intensity, number of grid points, max x position, max y position, max z position']
@@ -51,41 +73,199 @@ def segment_spots(map, smoothing_steps = 0):
     if segmentation.parent is not map.parent:
         session.models.add([segmentation], parent = map.parent)
 
-    # Quantify each region.
-    spots = []
-    for region in segmentation.regions:
-        ijk = region.points()
-        num_grid_points = len(ijk)
-        im,jm,km = region.max_point
-        m = map.matrix(step = 1)
-        from numpy import float64
-        mean = m.mean(dtype=float64)
-        map_values = m[ijk[:,2],ijk[:,1],ijk[:,0]]
-        total_intensity = map_values.sum() - num_grid_points * mean
-        mean_intensity = map_values.mean(dtype=float64) - mean
-        max_intensity = m[km,jm,im] - mean
-        spots.append((total_intensity, mean_intensity, max_intensity, num_grid_points, im, jm, km))
+    # Quantify all regions at once using a volume of region numbers.
+    m = map.matrix(step = 1)
+    from spotseg import region_labels, region_statistics
+    labels = region_labels([region.points() for region in segmentation.regions], m.shape)
+    spots = region_statistics(m, labels, len(segmentation.regions))
 
     # Sort from largest to smallest intensity.
     spots.sort(reverse = True)
     
     return spots
 
-def map_mean_and_sd(map):
+def watershed_spots(map, smoothing_steps = 0):
+    '''Segment using the map threshold level without Segger and quantify each region.'''
     m = map.matrix(step = 1)
-    from numpy import float64
-    mean = m.mean(dtype=float64)
-    sd = m.std(dtype=float64)
-    return mean, sd
+    from spotseg import watershed_regions, region_statistics
+    labels, num_regions = watershed_regions(m, map.minimum_surface_level, smoothing_steps)
+    spots = region_statistics(m, labels, num_regions)
+    spots.sort(reverse = True)
+    return spots
+
+def spots_series(session, maps, threshold_sdev = None, output_csv = None, smoothing_steps = 0,
+                 processes = None):
+    '''
+    Quantify spots in each map of a volume series using the watershed segmentation
+    in a pool of processes.  Results are written to the CSV file as each time point
+    finishes with the time point in the first column.
+    '''
+    from chimerax.core.errors import UserError
+    if threshold_sdev is None:
+        threshold = maps[0].minimum_surface_level
+        if threshold is None:
+            raise UserError('Map %s has no threshold, use the spots threshold option' % maps[0].name)
+    else:
+        threshold = None
+    tasks = []
+    for v in maps:
+        d = v.data
+        if not d.path or not isinstance(d.path, str):
+            raise UserError('Map %s was not read from a single file' % v.name)
+        tasks.append((d.path, d.file_type, getattr(d, 'time', None), getattr(d, 'channel', None),
+                      threshold, threshold_sdev, smoothing_steps))
+
+    file = open(output_csv, 'w') if output_csv else None
+    header = '# Time point, spot number, total intensity, mean intensity, max intensity, number of grid points, max x position, max y position, max z position\n'
+    lines = [header]
+    if file:
+        file.write(header)
+    counts = []
+    from spotseg import timepoint_spots, parallel_imap
+    try:
+        for t, spots in enumerate(parallel_imap(timepoint_spots, tasks, processes)):
+            rows = ''.join('%d,%d,%.5g,%.5g,%.5g,%d,%d,%d,%d\n' % ((t, i+1) + spot)
+                           for i,spot in enumerate(spots))
+            if file:
+                file.write(rows)
+                file.flush()
+            else:
+                lines.append(rows)
+            counts.append(len(spots))
+    except ValueError as e:
+        raise UserError('Time point %d failed: %s' % (len(counts), e))
+    finally:
+        if file:
+            file.close()
+
+    session.logger.info('Found %d spots in %d time points, %d to %d per time point'
+                        % (sum(counts), len(counts), min(counts), max(counts)))
+    if not file:
+        session.logger.info(''.join(lines))
+
+def spots_track(session, spots_csv, maps = None, max_displacement = 5, intensity_ratio = 2,
+                output_csv = None, markers = True, min_length = 2, radius = None):
+    '''
+    Link spots from a spots series CSV file into tracks and write the file again
+    with a track number column.  Displacements are in grid index units, or in scene
+    coordinates if the series maps are given.  Tracks of at least min_length
+    spots are shown as marker sets.
+    '''
+    from spottrack import read_spots_csv, track_spots, write_tracks_csv
+    try:
+        spots = read_spots_csv(spots_csv)
+    except (OSError, ValueError) as e:
+        from chimerax.core.errors import UserError
+        raise UserError(str(e))
+    xyz = spots_scene_coordinates(spots, maps)
+    track = track_spots(spots['time'], xyz, spots['total'], max_displacement, intensity_ratio)
+
+    if output_csv is None:
+        from os.path import splitext
+        output_csv = splitext(spots_csv)[0] + '_tracks.csv'
+    write_tracks_csv(output_csv, spots, track)
+
+    from numpy import bincount
+    lengths = bincount(track)
+    long_tracks = (lengths >= min_length).nonzero()[0]
+    session.logger.info('Linked %d spots into %d tracks, %d with at least %d spots, wrote %s'
+                        % (len(track), len(lengths)-1, len(long_tracks), min_length, output_csv))
+
+    if markers and len(long_tracks) > 0:
+        if radius is None:
+            radius = 0.5 * max_displacement
+        track_marker_sets(session, xyz, spots['time'], track, long_tracks, radius)
+
+def spots_scene_coordinates(spots, maps = None):
+    '''Spot maximum positions in scene coordinates using the map for each time point.'''
+    ijk = spots['ijk']
+    if not maps:
+        return ijk.astype('float32')
+    from numpy import empty, float32
+    xyz = empty(ijk.shape, float32)
+    time = spots['time']
+    for t in set(time.tolist()):
+        v = maps[t] if t < len(maps) else maps[0]
+        tspots = (time == t)
+        xyz[tspots] = v.scene_position * v.data.ijk_to_xyz(ijk[tspots])
+    return xyz
+
+def track_marker_sets(session, xyz, time, track, track_numbers, radius):
+    '''Make a marker set for each track with markers linked in time order.'''
+    from numpy import lexsort, searchsorted
+    order = lexsort((time, track))
+    starts = searchsorted(track[order], track_numbers, side = 'left')
+    ends = searchsorted(track[order], track_numbers, side = 'right')
+    from chimerax.markers import MarkerSet, create_link
+    from chimerax.core.colors import random_colors
+    colors = random_colors(len(track_numbers), seed = 0)
+    msets = []
+    for tnum, s, e, color in zip(track_numbers.tolist(), starts, ends, colors):
+        mset = MarkerSet(session, name = 'track %d' % tnum)
+        prev = None
+        for p in order[s:e]:
+            m = mset.create_marker(xyz[p], color, radius)
+            if prev is not None:
+                create_link(prev, m, color, 0.5*radius)
+            prev = m
+        msets.append(mset)
+    session.models.add_group(msets, name = 'spot tracks')
+    return msets
+
+def map_mean_and_sd(map, step = 1, slab_bytes = 2**26):
+    '''
+    Mean and standard deviation of map values reading the map from its file a few
+    z planes at a time, so maps larger than memory can be thresholded.  Results are
+    remembered for each map data and step.
+    '''
+    d = map.data
+    cache = getattr(d, '_spots_mean_sd', None)
+    if cache is None:
+        cache = d._spots_mean_sd = {}
+    if step not in cache:
+        from spotseg import slabs_mean_and_sd
+        cache[step] = slabs_mean_and_sd(map_slabs(d, step, slab_bytes))
+    return cache[step]
+
+def map_slabs(data, step = 1, slab_bytes = 2**26):
+    '''Yield z slabs of map values read from the file.'''
+    isz, jsz, ksz = data.size
+    ni, nj = (isz + step - 1) // step, (jsz + step - 1) // step
+    planes = max(1, slab_bytes // (8 * ni * nj))
+    for k in range(0, ksz, planes*step):
+        ksize = min(planes*step, ksz - k)
+        yield data.read_matrix((0,0,k), (isz,jsz,ksize), (step,step,step), None)
 
 def register_command(session):
-    from chimerax.core.commands import CmdDesc, register, FloatArg, SaveFileNameArg, IntArg
+    from chimerax.core.commands import CmdDesc, register, FloatArg, SaveFileNameArg, IntArg, EnumOf
     from chimerax.map import MapArg
     desc = CmdDesc(required= [('map', MapArg)],
                    keyword = [('threshold_sdev', FloatArg),
                               ('output_csv', SaveFileNameArg),
-                              ('smoothing_steps', IntArg)],
+                              ('smoothing_steps', IntArg),
+                              ('method', EnumOf(('segger', 'watershed')))],
                    synopsis = 'quantify spots in volume data')
     register('spots', desc, spots, logger=session.logger)
 
+    from chimerax.map import MapsArg
+    desc = CmdDesc(required= [('maps', MapsArg)],
+                   keyword = [('threshold_sdev', FloatArg),
+                              ('output_csv', SaveFileNameArg),
+                              ('smoothing_steps', IntArg),
+                              ('processes', IntArg)],
+                   synopsis = 'quantify spots in each map of a volume series')
+    register('spots series', desc, spots_series, logger=session.logger)
+
+    from chimerax.core.commands import OpenFileNameArg, BoolArg
+    desc = CmdDesc(required= [('spots_csv', OpenFileNameArg)],
+                   keyword = [('maps', MapsArg),
+                              ('max_displacement', FloatArg),
+                              ('intensity_ratio', FloatArg),
+                              ('output_csv', SaveFileNameArg),
+                              ('markers', BoolArg),
+                              ('min_length', IntArg),
+                              ('radius', FloatArg)],
+                   synopsis = 'link spots between time points into tracks')
+    register('spots track', desc, spots_track, logger=session.logger)
+
 register_command(session)
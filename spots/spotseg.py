@@ -0,0 +1,185 @@
+# --------------------------------------------------------------------------------------
+# Watershed segmentation and quantification of spots in a 3D numpy array without
+# using the Segger tool, so spots can be found in ChimeraX with no graphical user
+# interface (chimerax --nogui), for instance in batch jobs on a compute cluster.
+#
+# Grid points above threshold are assigned to the local maximum reached by
+# repeatedly stepping to the highest of the 26 neighbor grid points, as Segger does.
+# Smoothing steps then group regions whose maxima climb to the same maximum in
+# the map smoothed with a Gaussian of width step number times step size in grid units.
+#
+def watershed_regions(m, threshold, smoothing_steps = 0, step_size = 1):
+    '''
+    Return a volume with region numbers 1,2,3... for grid points in each region
+    and 0 for points below threshold, and the number of regions.
+    '''
+    from numpy import zeros, int32, unique, searchsorted, float32, ascontiguousarray
+    m = ascontiguousarray(m)
+    mflat = m.ravel()
+    points = (mflat >= threshold).nonzero()[0]
+
+    # Point each grid point to its highest neighbor, then follow pointers by
+    # doubling (pointer jumping) until every point points to its local maximum.
+    parent = searchsorted(points, steepest_ascent(m, points))
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            break
+        parent = grandparent
+    roots, region = unique(parent, return_inverse = True)
+    maxima = points[roots]
+
+    # Group regions that climb to the same maximum in a smoothed map.
+    for step in range(1, smoothing_steps+1):
+        from scipy.ndimage import gaussian_filter
+        smoothed = gaussian_filter(m.astype(float32), step * step_size)
+        peaks, group = unique(climb(smoothed, maxima), return_inverse = True)
+        if len(peaks) < len(maxima):
+            maxima = group_maxima(mflat, maxima, group, len(peaks))
+            region = group[region]
+
+    labels = zeros(m.shape, int32)
+    labels.ravel()[points] = region + 1
+    return labels, len(maxima)
+
+neighbor_offsets = [(dk,dj,di) for dk in (-1,0,1) for dj in (-1,0,1) for di in (-1,0,1)
+                    if (dk,dj,di) != (0,0,0)]
+
+def steepest_ascent(m, points):
+    '''For grid points given as flat indices return flat index of highest neighbor or itself.'''
+    from numpy import unravel_index, ravel_multi_index, where, inf
+    ksize, jsize, isize = m.shape
+    mflat = m.ravel()
+    k, j, i = unravel_index(points, m.shape)
+    best = points.copy()
+    best_value = mflat[points]
+    for dk, dj, di in neighbor_offsets:
+        nk, nj, ni = k+dk, j+dj, i+di
+        inside = (nk >= 0) & (nk < ksize) & (nj >= 0) & (nj < jsize) & (ni >= 0) & (ni < isize)
+        n = ravel_multi_index((nk, nj, ni), m.shape, mode = 'clip')
+        value = where(inside, mflat[n], -inf)
+        # Break ties by grid index so plateaus climb to a single point.
+        higher = (value > best_value) | ((value == best_value) & (n > best))
+        best[higher] = n[higher]
+        best_value[higher] = value[higher]
+    return best
+
+def climb(m, points):
+    '''Step each grid point uphill until it reaches a local maximum.'''
+    while True:
+        up = steepest_ascent(m, points)
+        if (up == points).all():
+            return points
+        points = up
+
+def group_maxima(mflat, maxima, group, num_groups):
+    '''Highest of the region maxima in each group.'''
+    from numpy import lexsort, bincount
+    order = lexsort((mflat[maxima], group))
+    last = bincount(group, minlength = num_groups).cumsum() - 1
+    return maxima[order[last]]
+
+def region_labels(region_points, shape):
+    '''Make a volume with value n for grid points in region n, 0 outside regions.'''
+    from numpy import zeros, int32
+    labels = zeros(shape, int32)
+    for r, ijk in enumerate(region_points):
+        labels[ijk[:,2],ijk[:,1],ijk[:,0]] = r+1
+    return labels
+
+def region_statistics(m, labels, num_regions):
+    '''
+    Return (total intensity, mean intensity, max intensity, number of grid points,
+    max x, max y, max z) for regions 1 to num_regions of a label volume.
+    Intensities are relative to the mean of the whole map.  All regions are
+    computed in one pass with bincount instead of indexing the map per region.
+    '''
+    from numpy import float64, bincount, lexsort, unravel_index
+    mean = m.mean(dtype=float64)
+    inside = (labels.ravel() > 0).nonzero()[0]
+    region = labels.ravel()[inside]
+    map_values = m.ravel()[inside]
+    n = num_regions + 1
+    num_grid_points = bincount(region, minlength = n)
+    total = bincount(region, weights = map_values, minlength = n)
+
+    # Grid index of maximum value in each region, last in each group sorted by region then value.
+    order = lexsort((map_values, region))
+    last = (num_grid_points.cumsum() - 1)[num_grid_points > 0]
+    max_index = inside[order[last]]
+    rnum = region[order[last]]
+    km, jm, im = unravel_index(max_index, m.shape)
+    max_value = m.ravel()[max_index]
+
+    spots = []
+    for r, mv, i, j, k in zip(rnum.tolist(), max_value.tolist(), im.tolist(), jm.tolist(), km.tolist()):
+        count = int(num_grid_points[r])
+        spots.append((total[r] - count * mean, total[r] / count - mean, mv - mean, count, i, j, k))
+    return spots
+
+# --------------------------------------------------------------------------------------
+# Quantify spots for each time point of a volume series in separate processes.
+# Each worker reads one time point from its file, so only the time points being
+# segmented are in memory.
+#
+def timepoint_spots(task):
+    '''Read one time point and return its spots sorted by total intensity.'''
+    path, file_type, time, channel, threshold, threshold_sdev, smoothing_steps = task
+    from chimerax.map_data import open_file
+    grids = open_file(path, file_type = file_type)
+    if len(grids) > 1:
+        grids = [g for g in grids if getattr(g, 'time', None) == time and
+                 getattr(g, 'channel', None) == channel]
+        if len(grids) == 0:
+            raise ValueError('File %s has no map for time %s channel %s' % (path, time, channel))
+    m = grids[0].matrix()
+    if threshold_sdev is not None:
+        mean, sd = slabs_mean_and_sd(array_slabs(m))
+        threshold = mean + threshold_sdev * sd
+    labels, num_regions = watershed_regions(m, threshold, smoothing_steps)
+    spots = region_statistics(m, labels, num_regions)
+    spots.sort(reverse = True)
+    return spots
+
+def parallel_imap(func, tasks, processes = None):
+    '''Apply func to each task in a pool of processes yielding results in task order.'''
+    if processes == 1:
+        for task in tasks:
+            yield func(task)
+        return
+    # Use spawn instead of fork since forking a graphical ChimeraX is not safe.
+    from multiprocessing import get_context
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers = processes, mp_context = get_context('spawn')) as pool:
+        yield from pool.map(func, tasks)
+
+# --------------------------------------------------------------------------------------
+# Mean and standard deviation of large maps computed a few z planes at a time
+# combining the slab statistics with the Welford / Chan et al. update, so no
+# float64 copy of the full map is needed.
+#
+def slabs_mean_and_sd(slabs):
+    '''Mean and standard deviation of all values from an iterable of arrays.'''
+    from numpy import float64
+    n, mean, m2 = 0, 0.0, 0.0
+    for slab in slabs:
+        nb = slab.size
+        if nb == 0:
+            continue
+        b = slab.astype(float64)
+        mb = b.mean()
+        b -= mb
+        m2b = float((b*b).sum())
+        delta = mb - mean
+        nt = n + nb
+        mean += delta * nb / nt
+        m2 += m2b + delta * delta * n * nb / nt
+        n = nt
+    sd = (m2 / n) ** 0.5 if n > 0 else 0.0
+    return mean, sd
+
+def array_slabs(m, slab_bytes = 2**26):
+    '''Yield z slabs of a 3D array each at most about slab_bytes as float64.'''
+    planes = max(1, slab_bytes // (8 * m[0].size)) if m.shape[0] > 0 else 1
+    for k in range(0, m.shape[0], planes):
+        yield m[k:k+planes]
@@ -0,0 +1,82 @@
+# --------------------------------------------------------------------------------------
+# Link spots found at each time point of a volume series ("spots series" output)
+# into tracks.  Candidate links between consecutive time points are spots within a
+# maximum displacement, found with a k-d tree so tens of thousands of spots per time
+# point do not need all pairwise distances.  Candidates are scored by displacement
+# and total intensity ratio and accepted greedily from best to worst score, each
+# spot having at most one link forward and one link backward.
+#
+def read_spots_csv(path):
+    '''Read a spots series CSV file into a dictionary of numpy arrays.'''
+    from numpy import loadtxt
+    columns = loadtxt(path, delimiter = ',', comments = '#', ndmin = 2)
+    if columns.shape[1] < 9:
+        raise ValueError(f'File {path} has {columns.shape[1]} columns, expected 9 columns made by spots series')
+    return {'time': columns[:,0].astype(int), 'spot': columns[:,1].astype(int),
+            'total': columns[:,2], 'mean': columns[:,3], 'max': columns[:,4],
+            'count': columns[:,5].astype(int), 'ijk': columns[:,6:9].astype(int)}
+
+def track_spots(time, xyz, intensity, max_displacement = 5, max_intensity_ratio = 2):
+    '''
+    Return a track number, 1,2,3..., for each spot.  Spots are given by arrays
+    of time point, position and intensity.  Spots with no links get their own track.
+    '''
+    from numpy import zeros, int64, unique
+    track = zeros((len(time),), int64)
+    times = unique(time)
+    next_track = 1
+    previous = t_prev = None
+    for t in times:
+        spots = (time == t).nonzero()[0]
+        if previous is not None and t == t_prev + 1:
+            i1, i2 = link_spots(xyz[previous], intensity[previous], xyz[spots], intensity[spots],
+                                max_displacement, max_intensity_ratio)
+            track[spots[i2]] = track[previous[i1]]
+        new = spots[track[spots] == 0]
+        track[new] = range(next_track, next_track + len(new))
+        next_track += len(new)
+        previous, t_prev = spots, t
+    return track
+
+def link_spots(xyz1, intensity1, xyz2, intensity2, max_displacement = 5, max_intensity_ratio = 2):
+    '''
+    Return index arrays i1, i2 of linked spots between two time points.
+    '''
+    from numpy import array, empty, int64, abs, log, maximum, argsort
+    if len(xyz1) == 0 or len(xyz2) == 0:
+        return empty((0,), int64), empty((0,), int64)
+    from scipy.spatial import cKDTree
+    pairs = cKDTree(xyz1).sparse_distance_matrix(cKDTree(xyz2), max_displacement,
+                                                output_type = 'ndarray')
+    i1, i2, d = pairs['i'], pairs['j'], pairs['v']
+
+    # Intensities must be within a factor of max_intensity_ratio.
+    tiny = 1e-30
+    ratio = abs(log(maximum(intensity2[i2], tiny) / maximum(intensity1[i1], tiny)))
+    ok = ratio <= log(max_intensity_ratio)
+    i1, i2 = i1[ok], i2[ok]
+    score = d[ok] / max_displacement + ratio[ok] / log(max_intensity_ratio)
+
+    # Accept best scoring links first.
+    used1, used2 = set(), set()
+    links1, links2 = [], []
+    for p in argsort(score, kind = 'stable').tolist():
+        s1, s2 = int(i1[p]), int(i2[p])
+        if s1 not in used1 and s2 not in used2:
+            used1.add(s1)
+            used2.add(s2)
+            links1.append(s1)
+            links2.append(s2)
+    return array(links1, int64), array(links2, int64)
+
+def write_tracks_csv(path, spots, track):
+    '''Write the spots series CSV columns with the track number added as the last column.'''
+    with open(path, 'w') as file:
+        file.write('# Time point, spot number, total intensity, mean intensity, max intensity, number of grid points, max x position, max y position, max z position, track number\n')
+        i, j, k = spots['ijk'].T
+        lines = ['%d,%d,%.5g,%.5g,%.5g,%d,%d,%d,%d,%d\n' % row
+                 for row in zip(spots['time'].tolist(), spots['spot'].tolist(),
+                                spots['total'].tolist(), spots['mean'].tolist(), spots['max'].tolist(),
+                                spots['count'].tolist(), i.tolist(), j.tolist(), k.tolist(),
+                                track.tolist())]
+        file.write(''.join(lines))
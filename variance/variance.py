@@ -2,27 +2,47 @@
 # for coloring regions that change.
 #
 #  volume variance #1-5
+#
+# The maps are read from their files a slab of z planes at a time and the variance
+# is accumulated with Welford's method in 64-bit floats, so hundreds of large maps
+# need only a few slabs in memory and maps with a large mean compared to their
+# variation give accurate variance.  With the saveFile option the variance is
+# written to an MRC file a slab at a time and opened from that file.
+#
+#  volume variance #1-200 saveFile variance.mrc
+#
+# Command volume pca computes the principal components of change over a series of
+# maps, optionally only for grid points where a mask map is above a level.  The
+# maps x maps Gram matrix of the mean-subtracted maps is accumulated a slab at a
+# time, then a second pass over the slabs makes the component maps.  Each component
+# map is the change of one standard deviation along that mode, and per-map scores
+# (map = mean + sum of score times component) are reported in the log.
+#
+#  volume pca #1-200 components 3 mask #201 scoresFile scores.csv
 
-def variance(session, maps):
-    sum = sum2 = None
-    for v in maps:
-        from numpy import float32
-        m = v.full_matrix().astype(float32)
-        if sum is None:
-            sum = m.copy()
-            sum2 = m*m
-        else:
-            if m.shape != sum.shape:
-                from chimerax.core.errors import UserError
-                raise UserError('Map %s' % v.name_with_id() +
-                                ' size (%d,%d,%d)' % tuple(v.data.size) +
-                                ' does not match map %s' % maps[0].name_with_id() +
-                                ' size (%d,%d,%d)' % tuple(maps[0].data.size))
-            sum += m
-            sum2 += m*m
-    n = len(maps)
-    var = sum2/n - (sum*sum)/(n*n)
+def variance(session, maps, save_file = None, slab_bytes = 2**26):
+    check_map_sizes(maps)
     d = maps[0].data
+    n = len(maps)
+    isz, jsz, ksz = d.size
+    if save_file is None:
+        from numpy import empty, float32
+        var = empty((ksz, jsz, isz), float32)
+    else:
+        mrc = MRCSlabWriter(save_file, d)
+    for k0, var_slab in variance_slabs(maps, slab_bytes):
+        if save_file is None:
+            var[k0:k0+len(var_slab)] = var_slab
+        else:
+            mrc.write(var_slab)
+
+    if save_file is not None:
+        mrc.close()
+        from chimerax.core.commands import run, quote_if_necessary
+        v = run(session, 'open %s' % quote_if_necessary(save_file))[0]
+        v.name = 'variance of %d maps' % n
+        return v
+
     from chimerax.map_data import ArrayGridData
     grid = ArrayGridData(var, origin = d.origin, step = d.step,
                          cell_angles = d.cell_angles, rotation = d.rotation,
@@ -30,12 +50,182 @@ def variance(session, maps):
     from chimerax.map import volume_from_grid_data
     v = volume_from_grid_data(grid, session)
     return v
-    
+
+def check_map_sizes(maps):
+    d = maps[0].data
+    for v in maps[1:]:
+        if tuple(v.data.size) != tuple(d.size):
+            from chimerax.core.errors import UserError
+            raise UserError('Map %s' % v.name_with_id() +
+                            ' size (%d,%d,%d)' % tuple(v.data.size) +
+                            ' does not match map %s' % maps[0].name_with_id() +
+                            ' size (%d,%d,%d)' % tuple(d.size))
+
+def variance_slabs(maps, slab_bytes = 2**26):
+    '''Yield (first z plane, float32 variance) for z slabs of a series of maps.'''
+    isz, jsz, ksz = maps[0].data.size
+    planes = max(1, slab_bytes // (8 * isz * jsz))
+    from numpy import zeros, float64, float32
+    for k0 in range(0, ksz, planes):
+        kn = min(planes, ksz - k0)
+        mean = zeros((kn, jsz, isz), float64)
+        m2 = zeros((kn, jsz, isz), float64)
+        for count, v in enumerate(maps, 1):
+            m = map_slab(v, k0, kn).astype(float64)
+            delta = m - mean
+            mean += delta / count
+            m -= mean
+            m2 += delta * m
+        yield k0, (m2 / len(maps)).astype(float32)
+
+def map_slab(v, k0, kn):
+    '''Read z planes k0 to k0+kn-1 of a map from its file without caching them.'''
+    d = v.data
+    isz, jsz, ksz = d.size
+    return d.read_matrix((0, 0, k0), (isz, jsz, kn), (1, 1, 1), None)
+
+class MRCSlabWriter:
+    '''Write a float32 MRC file one z slab at a time.'''
+    def __init__(self, path, grid_data):
+        self.file = open(path, 'wb')
+        self.grid_data = grid_data
+        self._min = self._max = None
+        self._sum = self._sum2 = 0.0
+        self._count = 0
+        self.file.write(mrc_header(grid_data, 0, 0, 0, 0))
+
+    def write(self, slab):
+        from numpy import float64
+        self._min = slab.min() if self._min is None else min(self._min, slab.min())
+        self._max = slab.max() if self._max is None else max(self._max, slab.max())
+        self._sum += slab.sum(dtype = float64)
+        self._sum2 += (slab.astype(float64)**2).sum()
+        self._count += slab.size
+        slab.astype('<f4').tofile(self.file)
+
+    def close(self):
+        # Rewrite the header with the value range and mean.
+        mean = self._sum / self._count
+        rms = max(0, self._sum2 / self._count - mean*mean) ** 0.5
+        self.file.seek(0)
+        self.file.write(mrc_header(self.grid_data, self._min, self._max, mean, rms))
+        self.file.close()
+
+def mrc_header(d, dmin, dmax, dmean, rms):
+    '''MRC 2014 header for float32 values with the grid size, spacing and origin.'''
+    from struct import pack
+    nx, ny, nz = d.size
+    cx, cy, cz = [s*st for s, st in zip(d.size, d.step)]
+    alpha, beta, gamma = d.cell_angles
+    ox, oy, oz = d.origin
+    header = pack('<10i6f3i3f2i', nx, ny, nz, 2, 0, 0, 0, nx, ny, nz,
+                  cx, cy, cz, alpha, beta, gamma, 1, 2, 3, dmin, dmax, dmean, 1, 0)
+    header += pack('<25i', 0, 0, 0, 20140, *([0]*21))
+    header += pack('<3f4s4sfi', ox, oy, oz, b'MAP ', b'\x44\x44\x00\x00', rms, 0)
+    header += bytes(800)
+    return header
+
+def pca(session, maps, components = 3, mask = None, mask_level = 0, scores_file = None,
+        slab_bytes = 2**28):
+    n = len(maps)
+    if n < 2:
+        from chimerax.core.errors import UserError
+        raise UserError('Need at least 2 maps for principal components, got %d' % n)
+    check_map_sizes(maps if mask is None else maps + [mask])
+    d = maps[0].data
+
+    # Gram matrix of mean-subtracted maps over masked grid points.
+    from numpy import zeros, float64, float32, sqrt
+    gram = zeros((n, n), float64)
+    for k0, kn, inside, x in masked_slabs(maps, mask, mask_level, slab_bytes):
+        gram += x @ x.T
+
+    # Eigenvectors with largest eigenvalues give map scores, scaled so map
+    # scores have root mean square 1 and component maps are one standard deviation.
+    from numpy.linalg import eigh
+    evals, evecs = eigh(gram)
+    order = evals.argsort()[::-1][:min(components, n-1)]
+    evals, evecs = evals[order].clip(min = 0), evecs[:,order]
+    nc = len(order)
+    weights = evecs / sqrt(n)
+    scores = evecs * sqrt(n)
+
+    isz, jsz, ksz = d.size
+    cmaps = zeros((nc, ksz, jsz, isz), float32)
+    for k0, kn, inside, x in masked_slabs(maps, mask, mask_level, slab_bytes):
+        c = weights.T @ x
+        for i in range(nc):
+            cflat = cmaps[i,k0:k0+kn].reshape(-1)
+            if inside is None:
+                cflat[:] = c[i]
+            else:
+                cflat[inside] = c[i]
+
+    from chimerax.map_data import ArrayGridData
+    from chimerax.map import volume_from_grid_data
+    volumes = []
+    for i in range(nc):
+        grid = ArrayGridData(cmaps[i], origin = d.origin, step = d.step,
+                             cell_angles = d.cell_angles, rotation = d.rotation,
+                             name = 'component %d of %d maps' % (i+1, n))
+        volumes.append(volume_from_grid_data(grid, session))
+
+    total = gram.trace()
+    fractions = evals / total if total > 0 else evals
+    lines = ['Component %d, %.1f%% of variance' % (i+1, 100*f) for i,f in enumerate(fractions)]
+    lines.append('Map scores, ' + ', '.join('component %d' % (i+1) for i in range(nc)))
+    lines.extend('%s, ' % v.name_with_id() + ', '.join('%.3f' % s for s in mscores)
+                 for v, mscores in zip(maps, scores))
+    session.logger.info('\n'.join(lines))
+    if scores_file:
+        with open(scores_file, 'w') as file:
+            file.write('# Map, ' + ', '.join('component %d' % (i+1) for i in range(nc)) + '\n')
+            file.write(''.join('%s,' % v.name + ','.join('%.5g' % s for s in mscores) + '\n'
+                               for v, mscores in zip(maps, scores)))
+    return volumes
+
+def masked_slabs(maps, mask = None, mask_level = 0, slab_bytes = 2**28):
+    '''
+    Yield (first z plane, number of planes, masked flat indices or None, maps x points
+    float64 values minus mean over maps) for z slabs of a series of maps.
+    '''
+    n = len(maps)
+    isz, jsz, ksz = maps[0].data.size
+    planes = max(1, slab_bytes // (8 * n * isz * jsz))
+    from numpy import empty, float64
+    for k0 in range(0, ksz, planes):
+        kn = min(planes, ksz - k0)
+        if mask is None:
+            inside = None
+            npoints = kn * jsz * isz
+        else:
+            inside = (map_slab(mask, k0, kn).ravel() > mask_level).nonzero()[0]
+            npoints = len(inside)
+            if npoints == 0:
+                continue
+        x = empty((n, npoints), float64)
+        for i, v in enumerate(maps):
+            m = map_slab(v, k0, kn).ravel()
+            x[i] = m if inside is None else m[inside]
+        x -= x.mean(axis = 0)
+        yield k0, kn, inside, x
+
 def register_command(session):
-    from chimerax.core.commands import CmdDesc, register
+    from chimerax.core.commands import CmdDesc, register, SaveFileNameArg
     from chimerax.map import MapsArg
     desc = CmdDesc(required=[('maps', MapsArg)],
+                   keyword=[('save_file', SaveFileNameArg)],
                    synopsis='Compute volume per-pixel variance')
     register('volume variance', desc, variance, logger=session.logger)
 
+    from chimerax.core.commands import IntArg, FloatArg
+    from chimerax.map import MapArg
+    desc = CmdDesc(required=[('maps', MapsArg)],
+                   keyword=[('components', IntArg),
+                            ('mask', MapArg),
+                            ('mask_level', FloatArg),
+                            ('scores_file', SaveFileNameArg)],
+                   synopsis='Compute principal component maps of a map series')
+    register('volume pca', desc, pca, logger=session.logger)
+
 register_command(session)